@@ -1,54 +1,218 @@
+import bisect
+import io
 import struct
 import os
+import mmap
+import re
 from datetime import datetime
 
+import numpy as np
+
 # [cite_start]Константы структуры файла [cite: 5]
 HEADER_FORMAT = "<ii"      # 8 байт (from_id, to_id)
 RECORD_FORMAT = "<iiiiiii"  # 28 байт (type, id, timestamp, who, p0, p1, p2)
 RECORD_SIZE = 28
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
 
-def parse_board_file(filepath):
-    """Читает бинарный файл и возвращает список записей."""
-    data_list = []
-    
-    if not os.path.exists(filepath):
-        return []
-
-    with open(filepath, 'rb') as f:
-        # Пропускаем заголовок (8 байт)
-        f.read(struct.calcsize(HEADER_FORMAT))
-
-        while True:
-            chunk = f.read(RECORD_SIZE)
-            if len(chunk) < RECORD_SIZE:
-                break
-            
-            # [cite_start]Распаковываем байты в числа [cite: 5]
-            rtype, rid, ts, role_id, p0, p1, p2 = struct.unpack(RECORD_FORMAT, chunk)
-            
-            # Фильтр: игнорируем даты из 1970 года (пустые записи)
-            if ts < 1600000000: # Отсекаем всё, что старше ~2020 года
-                continue
-                
+# Тот же RECORD_FORMAT, но в виде структурного dtype для разбора всего файла разом
+RECORD_DTYPE = np.dtype([
+    ("type", "<i4"),
+    ("id", "<i4"),
+    ("timestamp", "<i4"),
+    ("role_id", "<i4"),
+    ("p0", "<i4"),
+    ("p1", "<i4"),
+    ("p2", "<i4"),
+])
+
+MIN_TIMESTAMP = 1600000000  # Отсекаем всё, что старше ~2020 года (пустые записи)
+
+
+BOARD_NAME_RE = re.compile(r"FactionBoard[0-9A-Za-z_-]*")
+
+
+def board_key(filename):
+    """
+    Ключ фракции для учета загруженных id: имя файла без пути и без приписок
+    вида " (1)", которые добавляют Telegram/браузер к копиям.
+    """
+    name = os.path.basename(filename or "")
+    m = BOARD_NAME_RE.match(name)
+    return m.group(0) if m else name
+
+
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+
+def _covered_prefix(covered, from_id):
+    """Конец загруженного диапазона, в который попадает from_id (начало файла), иначе None."""
+    i = bisect.bisect_right(covered, (from_id, float("inf"))) - 1
+    if i >= 0 and covered[i][0] <= from_id <= covered[i][1]:
+        return covered[i][1]
+    return None
+
+
+def _skip_index(id_at, count, from_id, last_id):
+    """
+    Сколько записей в начале файла можно пропустить целиком: все id от from_id
+    до last_id уже загружены. Записи идут подряд с from_id, поэтому запись
+    с id == last_id лежит по индексу last_id - from_id. Если там другой id
+    (файл склеен из нескольких страниц) - ничего не пропускаем, остается фильтр по id.
+    Решение принимается только по id самих записей, не по to_id заголовка.
+    """
+    skip = last_id - from_id + 1
+    if skip <= 0 or skip > count:
+        return 0
+    return skip if id_at(skip - 1) == last_id else 0
+
+
+def parse_board_columns(source, covered=None, sort=True):
+    """
+    Векторный разбор файла (путь - через mmap, либо bytes/бинарный поток из памяти).
+    Возвращает словарь колонок (numpy-массивы по полям RECORD_DTYPE),
+    отфильтрованных по дате; sort - новые сверху, иначе в порядке файла.
+    covered - уже загруженные диапазоны id [(lo, hi), ...]: такие записи пропускаются.
+    """
+    if isinstance(source, BUFFER_TYPES):
+        return _columns_from_buffer(source, covered, sort)
+
+    if not isinstance(source, (str, os.PathLike)):
+        # Загрузка из памяти (UploadFile, BytesIO): читаем от текущей позиции
+        return _columns_from_buffer(source.read(), covered, sort)
+
+    if not os.path.exists(source):
+        return _empty_columns()
+
+    with open(source, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER_SIZE + RECORD_SIZE:
+            return _empty_columns()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Фильтр и сортировка копируют данные, после этого mmap можно закрывать
+            return _columns_from_buffer(mm, covered, sort)
+
+
+def _columns_from_buffer(buf, covered=None, sort=True):
+    size = len(buf)
+    if size < HEADER_SIZE + RECORD_SIZE:
+        return _empty_columns()
+
+    count = (size - HEADER_SIZE) // RECORD_SIZE
+    offset = HEADER_SIZE
+    if covered:
+        from_id, _ = struct.unpack_from(HEADER_FORMAT, buf)
+        last_id = _covered_prefix(covered, from_id)
+        if last_id is not None:
+            id_at = lambda i: struct.unpack_from("<i", buf, HEADER_SIZE + i * RECORD_SIZE + 4)[0]
+            skip = _skip_index(id_at, count, from_id, last_id)
+            offset += skip * RECORD_SIZE
+            count -= skip
+
+    records = np.frombuffer(buf, dtype=RECORD_DTYPE, count=count, offset=offset)
+    mask = records["timestamp"] >= MIN_TIMESTAMP
+    if covered:
+        los = np.array([lo for lo, _ in covered], dtype=np.int64)
+        his = np.array([hi for _, hi in covered], dtype=np.int64)
+        ids = records["id"].astype(np.int64)
+        pos = np.searchsorted(los, ids, side="right") - 1
+        mask &= ~((pos >= 0) & (ids <= his[np.maximum(pos, 0)]))
+    records = records[mask]
+    if sort:
+        order = np.argsort(-records["timestamp"].astype(np.int64), kind="stable")
+        records = records[order]
+
+    return {name: np.ascontiguousarray(records[name]) for name in RECORD_DTYPE.names}
+
+
+def _empty_columns():
+    return {name: np.empty(0, dtype=RECORD_DTYPE[name]) for name in RECORD_DTYPE.names}
+
+
+class BoardRecord:
+    """Запись FactionBoard. Дата и описание считаются только по запросу, дата - один раз."""
+    __slots__ = ("type", "id", "timestamp", "role_id", "p0", "p1", "p2", "_date")
+
+    def __init__(self, rtype, rid, ts, role_id, p0, p1, p2):
+        self.type = rtype
+        self.id = rid
+        self.timestamp = ts
+        self.role_id = role_id
+        self.p0 = p0
+        self.p1 = p1
+        self.p2 = p2
+        self._date = None
+
+    @property
+    def date(self):
+        if self._date is None:
             try:
-                dt = datetime.fromtimestamp(ts)
-                dt_str = dt.strftime('%Y-%m-%d %H:%M:%S')
+                self._date = datetime.fromtimestamp(self.timestamp).strftime('%Y-%m-%d %H:%M:%S')
             except:
-                dt_str = "Error Date"
-
-            desc = decode_action(rtype, role_id, p0, p1, p2)
-            
-            data_list.append({
-                "date": dt_str,
-                "timestamp": ts,
-                "role_id": role_id,
-                "action_type": rtype,
-                "description": desc,
-                "raw_params": f"{p0}, {p1}, {p2}"
-            })
-            
-    # Сортируем: новые сверху
-    data_list.sort(key=lambda x: x['timestamp'], reverse=True)
+                self._date = "Error Date"
+        return self._date
+
+    @property
+    def day(self):
+        """День события числом YYYYMMDD (колонка events.day) - из той же строки даты, что и date."""
+        date = self.date
+        return None if date == "Error Date" else int(date[:10].replace("-", ""))
+
+    @property
+    def description(self):
+        return decode_action(self.type, self.role_id, self.p0, self.p1, self.p2)
+
+    def __repr__(self):
+        return f"BoardRecord(type={self.type}, id={self.id}, ts={self.timestamp}, role_id={self.role_id})"
+
+
+def iter_board_batches(source, batch_size=1024, covered=None):
+    """
+    Чтение файла пачками по batch_size записей поверх parse_board_columns:
+    файл разбирается векторно целиком (путь - через mmap), а объекты BoardRecord
+    создаются только для текущей пачки.
+    source - путь к файлу, bytes/memoryview или открытый бинарный поток.
+    Записи отдаются в порядке файла, без сортировки; старые (до 2020) отбрасываются.
+    covered - уже загруженные диапазоны id [(lo, hi), ...] по возрастанию: такие записи
+    пропускаются. Старые архивы и записи, дописанные за to_id заголовка, не теряются:
+    решение - только по id записей.
+    """
+    cols = parse_board_columns(source, covered, sort=False)
+    fields = [cols[name] for name in RECORD_DTYPE.names]
+    for start in range(0, len(fields[0]), batch_size):
+        rows = zip(*(column[start:start + batch_size].tolist() for column in fields))
+        yield [BoardRecord(*row) for row in rows]
+
+
+def iter_board_records(source, batch_size=1024, covered=None):
+    """То же, что iter_board_batches, но по одной записи."""
+    for batch in iter_board_batches(source, batch_size, covered):
+        yield from batch
+
+
+def parse_board_file(source):
+    """Читает бинарный файл и возвращает список записей (обертка над parse_board_columns)."""
+    cols = parse_board_columns(source)
+
+    data_list = []
+    rows = zip(
+        cols["type"].tolist(), cols["timestamp"].tolist(), cols["role_id"].tolist(),
+        cols["p0"].tolist(), cols["p1"].tolist(), cols["p2"].tolist(),
+    )
+    for rtype, ts, role_id, p0, p1, p2 in rows:
+        try:
+            dt = datetime.fromtimestamp(ts)
+            dt_str = dt.strftime('%Y-%m-%d %H:%M:%S')
+        except:
+            dt_str = "Error Date"
+
+        data_list.append({
+            "date": dt_str,
+            "timestamp": ts,
+            "role_id": role_id,
+            "action_type": rtype,
+            "description": decode_action(rtype, role_id, p0, p1, p2),
+            "raw_params": f"{p0}, {p1}, {p2}"
+        })
+
     return data_list
 
 def decode_action(rtype, who, p0, p1, p2):
@@ -61,12 +225,12 @@ def decode_action(rtype, who, p0, p1, p2):
     if rtype == 6: return "Вступил в гильдию"
     if rtype == 7: return "Отказался вступить"
     if rtype == 8: return "Покинул гильдию"
-    if rtype == 9: 
+    if rtype == 9:
         # [cite_start]p1 - роль, p2 - направление (1=повысил, иначе понизил) [cite: 8]
         role_map = {2: "Мастер", 3: "Маршал", 4: "Майор", 5: "Капитан", 6: "Рядовой"}
         role = role_map.get(p1, str(p1))
         act = "Повысил" if p2 == 1 else "Понизил"
         return f"{act} ID {p0} до {role}"
     if rtype == 10: return f"Изгнал ID {p0}"
-    
-    return f"Действие {rtype}"
\ No newline at end of file
+
+    return f"Действие {rtype}"
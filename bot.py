@@ -1,7 +1,5 @@
 import asyncio
 import os
-import csv
-import aiosqlite
 import logging
 import sys
 
@@ -10,10 +8,12 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.types import FSInputFile
 from dotenv import load_dotenv
-from aiogram.types import BufferedInputFile 
-import io
+from aiogram.types import InputFile
 from aiogram.types import FSInputFile, WebAppInfo, InlineKeyboardMarkup, InlineKeyboardButton
 from consts import CLASSES, CLASS_BY_NAME
+from db import db, bump_generation
+from export import EXPORT_FORMATS, export_count, export_rows, export_stream
+from migrations import migrate, start_backfills
 
 
 # Настройка логирования (чтобы видеть ошибки в консоли)
@@ -21,7 +21,7 @@ logging.basicConfig(level=logging.INFO)
 
 # Импортируем наш парсер
 try:
-    from board_parser import parse_board_file
+    from ingest import ingest_file
 except ImportError as e:
     logging.error(f"❌ ОШИБКА ИМПОРТА: {e}")
     logging.error("Убедись, что файл называется board_parser.py и лежит рядом с bot.py")
@@ -42,56 +42,6 @@ except Exception as e:
     logging.error(f"❌ ОШИБКА ПРИ СОЗДАНИИ БОТА: {e}")
     sys.exit(1)
 
-DB_NAME = "clan_archive.db"
-
-async def init_db():
-    """Создает таблицы и обновляет структуру при необходимости."""
-    async with aiosqlite.connect(DB_NAME) as conn:
-        cursor = await conn.cursor()
-        
-        # 1. Таблица ИГРОКОВ
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS players (
-                role_id INTEGER PRIMARY KEY,
-                nickname TEXT DEFAULT NULL,
-                first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                in_clan INTEGER DEFAULT 1,
-                class_id INTEGER DEFAULT -1
-            )
-        """)
-        
-        # --- МИГРАЦИЯ: Если таблицы старые, добавляем колонку in_clan ---
-        try:
-            await cursor.execute("ALTER TABLE players ADD COLUMN in_clan INTEGER DEFAULT 1")
-            logging.info("🛠 Добавлена колонка in_clan в таблицу players")
-        except Exception: 
-            pass 
-
-        # --- МИГРАЦИЯ: Добавляем class_id ---
-        try:
-            await cursor.execute("ALTER TABLE players ADD COLUMN class_id INTEGER DEFAULT -1")
-            logging.info("🛠 Добавлена колонка class_id в таблицу players")
-        except Exception:
-            pass
-            
-        # 2. Таблица СОБЫТИЙ
-        await cursor.execute("""
-            CREATE TABLE IF NOT EXISTS events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                role_id INTEGER,
-                timestamp INTEGER,
-                event_date TEXT,
-                event_type INTEGER, 
-                value INTEGER,
-                raw_desc TEXT,
-                UNIQUE(role_id, timestamp, event_type) ON CONFLICT IGNORE
-            )
-        """)
-        await cursor.execute("CREATE INDEX IF NOT EXISTS idx_date ON events (event_date)")
-        await cursor.execute("CREATE INDEX IF NOT EXISTS idx_type ON events (event_type)")
-        await conn.commit()
-        
-    logging.info("💾 База данных инициализирована и проверена.")
 # --- ХЭНДЛЕРЫ ---
 
 @dp.message(Command("start"))
@@ -122,71 +72,27 @@ async def handle_file(message: types.Message):
     if not doc.file_name.startswith("FactionBoard"):
         return await message.answer("⚠️ Кидай только файлы, начинающиеся на `FactionBoard`.")
 
-    temp_path = f"temp_{doc.file_name}"
-    await bot.download(doc, destination=temp_path)
-    
     try:
-        data = parse_board_file(temp_path)
-        logging.info(f"📂 Распаршено записей из файла: {len(data)}")
+        # Скачиваем прямо в память (BytesIO), без временного файла
+        buffer = await bot.download(doc)
+        async with db.write() as conn:
+            result = await ingest_file(conn, buffer.getvalue(), doc.file_name)
+        total = result["total_parsed"]
+        new_events = result["new_events"]
+        new_players = result["new_players"]
         
-        if not data:
-            return await message.answer("❌ Файл пуст, не содержит записей или все записи слишком старые (фильтр 2020+).")
+        if result["duplicate"]:
+            return await message.answer("ℹ️ Этот файл уже загружали раньше, пропускаю.")
 
-        new_events = 0
-        new_players = 0
-        
+        logging.info(f"📂 Распаршено записей из файла: {total}")
+        if not total:
+            if result["had_ranges"]:
+                return await message.answer("ℹ️ Новых записей нет: всё из этого файла уже есть в базе.")
+            return await message.answer("❌ Файл пуст, не содержит записей или все записи слишком старые (фильтр 2020+).")
 
-        async with aiosqlite.connect(DB_NAME) as conn:
-            cursor = await conn.cursor()
-            
-            for row in data:
-                rid = row['role_id']
-                etype = row['action_type']
-                desc = row['description'].lower() # Текст события маленькими буквами
-                
-                # 1. Добавляем игрока (или обновляем, если он уже есть)
-                # По умолчанию считаем, что если он в логах - он был в клане
-                await cursor.execute("INSERT OR IGNORE INTO players (role_id, in_clan) VALUES (?, 1)", (rid,))
-                if cursor.rowcount > 0:
-                    new_players += 1
-                
-                # --- ЛОГИКА СТАТУСА (В КЛАНЕ / ВЫШЕЛ) ---
-                
-                # Сценарий А: Игрок ВЫШЕЛ или ИЗГНАН
-                # Ищем слова "покинул", "изгнан", "leave", "quit", "kicked"
-                # А также проверяем типы событий (обычно 5, 6, 201, 202 - зависит от версии)
-                is_leave_event = False
-                if "покинул" in desc or "изгнан" in desc or "вышел" in desc:
-                    is_leave_event = True
-                # Если у тебя английский сервер: if "left" in desc or "kicked" in desc:
-                
-                if is_leave_event:
-                    await cursor.execute("UPDATE players SET in_clan = 0 WHERE role_id = ?", (rid,))
-                
-                # Сценарий Б: Игрок ПРИНЯТ или СДЕЛАЛ ВКЛАД
-                # Если есть запись о вкладе (тип 1, 2) или вступлении (обычно 3, 4) - значит он ВНУТРИ
-                elif etype in [1, 2] or "принят" in desc or "joined" in desc:
-                    await cursor.execute("UPDATE players SET in_clan = 1 WHERE role_id = ?", (rid,))
-                
-                # ----------------------------------------
-
-                # 2. Определяем Value (как и раньше)
-                params = list(map(int, row['raw_params'].split(',')))
-                val = params[0] if params else 0
-                
-                # 3. Пишем событие
-                await cursor.execute("""
-                    INSERT INTO events (role_id, timestamp, event_date, event_type, value, raw_desc)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (rid, row['timestamp'], row['date'], etype, val, row['description']))
-                
-                if cursor.rowcount > 0:
-                    new_events += 1
-            await conn.commit()
-        
         text = (
             f"📥 **Импорт завершен!**\n"
-            f"📊 Найдено в файле: <b>{len(data)}</b>\n"
+            f"📊 Найдено в файле: <b>{total}</b>\n"
             f"🆕 Новых событий: <b>{new_events}</b>\n"
             f"👤 Новых ID в базе: <b>{new_players}</b>\n\n"
             f"База растёт! 📈"
@@ -196,61 +102,48 @@ async def handle_file(message: types.Message):
     except Exception as e:
         logging.error(f"Ошибка обработки файла: {e}")
         await message.answer(f"Ошибка: {e}")
-    finally:
-        if os.path.exists(temp_path): os.remove(temp_path)
+
+
+class StreamInputFile(InputFile):
+    """Документ, который aiogram читает из асинхронного потока байтов (без буфера в памяти)."""
+
+    def __init__(self, stream_factory, filename):
+        super().__init__(filename=filename)
+        self.stream_factory = stream_factory
+
+    async def read(self, bot):
+        async for chunk in self.stream_factory():
+            yield chunk
 
 
 @dp.message(Command("report"))
 async def cmd_report(message: types.Message):
-    """Генерирует CSV с суммой вкладов по дням (надежный метод)"""
-    
-    # 1. Достаем данные
-    async with aiosqlite.connect(DB_NAME) as conn:
-        sql = """
-            SELECT 
-                p.role_id,
-                COALESCE(p.nickname, 'Unknown ID'),
-                substr(e.event_date, 1, 10) as day,
-                SUM(CASE WHEN e.event_type = 2 THEN e.value ELSE 0 END) as gold,
-                SUM(CASE WHEN e.event_type = 1 THEN e.value ELSE 0 END) as valor
-            FROM events e
-            LEFT JOIN players p ON e.role_id = p.role_id
-            WHERE e.event_type IN (1, 2)
-            GROUP BY p.role_id, day
-            ORDER BY day DESC, gold DESC
-        """
-        cursor = await conn.execute(sql)
-        rows = await cursor.fetchall()
-
-    logging.info(f"📊 Запрос к БД вернул строк: {len(rows)}")
-
-    if not rows:
+    """Отправляет CSV с суммой вкладов и этапами по дням (из сводки daily_stats).
+    /report xlsx - то же в Excel."""
+    args = message.text.split()
+    fmt = args[1].lower() if len(args) > 1 else "csv"
+    if fmt not in EXPORT_FORMATS:
+        return await message.answer("Формат: /report или /report xlsx")
+
+    async with db.read() as conn:
+        total = await export_count(conn)
+
+    logging.info(f"📊 Строк для отчета: {total}")
+
+    if not total:
         return await message.answer("📭 В базе нет записей о вкладах.")
 
-    # 2. Пишем в байтовый буфер (BytesIO)
-    output_bytes = io.BytesIO()
-    # Оборачиваем байтовый поток в текстовый для CSV
-    text_wrapper = io.TextIOWrapper(output_bytes, encoding='utf-8-sig', newline='')
-    
-    writer = csv.writer(text_wrapper, delimiter=';')
-    writer.writerow(["Role_ID", "Ник", "Дата", "Золото", "Доблесть"])
-    writer.writerows(rows)
-    
-    # ВАЖНО: Сбрасываем данные из текстовой обертки в байтовый буфер
-    text_wrapper.flush()
-    # Перематываем буфер в начало (на всякий случай)
-    output_bytes.seek(0)
-    
-    # Получаем чистые байты
-    file_data = output_bytes.getvalue()
-    
-    logging.info(f"📦 Размер сформированного файла: {len(file_data)} байт")
+    async def stream():
+        # Строки идут из курсора порциями - память не зависит от размера архива;
+        # соединение свое, пока файл уходит в Telegram, пул читателей свободен
+        async with db.stream() as conn:
+            async for chunk in export_stream(fmt, export_rows(conn)):
+                yield chunk
 
-    # 3. Отправляем
-    filename = f"report_{datetime.now().strftime('%Y%m%d')}.csv"
-    file = BufferedInputFile(file_data, filename=filename)
+    filename = f"report_{datetime.now().strftime('%Y%m%d')}.{fmt}"
+    file = StreamInputFile(stream, filename=filename)
     
-    await message.answer_document(file, caption=f"📊 Отчет: {len(rows)} строк.")
+    await message.answer_document(file, caption=f"📊 Отчет: {total} строк.")
 
 @dp.message(Command("name"))
 async def cmd_set_name(message: types.Message):
@@ -258,8 +151,9 @@ async def cmd_set_name(message: types.Message):
         # /name 123456 SuperNagibator
         _, rid, nick = message.text.split(maxsplit=2)
 
-        async with aiosqlite.connect(DB_NAME) as conn:
+        async with db.write() as conn:
             await conn.execute("UPDATE players SET nickname = ? WHERE role_id = ?", (nick, rid))
+            await bump_generation(conn)
             await conn.commit()
         await message.answer(f"✅ ID {rid} теперь известен как <b>{nick}</b>", parse_mode="HTML")
     except:
@@ -284,7 +178,7 @@ async def cmd_set_class(message: types.Message):
         cid = CLASS_BY_NAME[class_str]
         cname, cemoji, cshort = CLASSES[cid]
 
-        async with aiosqlite.connect(DB_NAME) as conn:
+        async with db.write() as conn:
             # Проверяем, есть ли такой ID
             async with conn.execute("SELECT 1 FROM players WHERE role_id = ?", (rid,)) as cursor:
                 if not await cursor.fetchone():
@@ -292,6 +186,7 @@ async def cmd_set_class(message: types.Message):
                     return
 
             await conn.execute("UPDATE players SET class_id = ? WHERE role_id = ?", (cid, rid))
+            await bump_generation(conn)
             await conn.commit()
             
         await message.answer(f"✅ Для ID {rid} установлен класс: {cemoji} <b>{cname}</b>", parse_mode="HTML")
@@ -300,14 +195,20 @@ async def cmd_set_class(message: types.Message):
 
 async def main():
     print(">>> Запуск бота...")
-    await init_db()
+    await db.open()
+    await migrate(db)
+    backfill_task = start_backfills(db)
     print("💾 База данных подключена/создана.")
     
     # Удаляем вебхуки
     await bot.delete_webhook(drop_pending_updates=True)
     
     print(">>> Бот запущен! (Нажми Ctrl+C для остановки)")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        backfill_task.cancel()
+        await db.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,34 @@
+import hashlib
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Готовые ответы (bytes) в памяти процесса, по ключу запроса.
+    Запись годна, пока поколение данных (meta.generation) не изменилось;
+    при переполнении вытесняются давно не запрашивавшиеся ключи.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (generation, body)
+
+    def get(self, key, generation):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, generation, body):
+        self.entries[key] = (generation, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return body
+
+
+def make_etag(generation, key):
+    """ETag ответа: поколение данных + хэш параметров запроса."""
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    return f'"g{generation}-{digest}"'
@@ -0,0 +1,158 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+DB_NAME = "clan_archive.db"
+
+# Настройки соединений: WAL - читатели не ждут загрузок, NORMAL - без fsync на каждый commit
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA mmap_size = 268435456",   # 256 МБ
+    "PRAGMA cache_size = -32000",     # ~32 МБ на соединение
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+def _casefold(text):
+    """SQL-функция casefold(text): сравнение без учета регистра для любых букв (встроенный LIKE - только ASCII)."""
+    return text.casefold() if isinstance(text, str) else text
+
+
+def search_pattern(text):
+    """LIKE-шаблон подстроки text для сравнения с casefold(колонка) ... ESCAPE '\\'."""
+    escaped = text.casefold().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+class Database:
+    """
+    Долгоживущие соединения на весь процесс: небольшой пул читателей и один писатель.
+    Создается при старте приложения (open) и закрывается при остановке (close).
+    Долгие выгрузки читают через отдельные соединения (stream), не занимая пул.
+    """
+
+    def __init__(self, path=DB_NAME, readers=3, streams=4):
+        self.path = path
+        self.readers_count = readers
+        self.readers = None
+        self.writer = None
+        self.write_lock = asyncio.Lock()
+        self.stream_slots = asyncio.Semaphore(streams)  # Одновременных выгрузок
+
+    async def _connect(self, read_only=False):
+        conn = await aiosqlite.connect(self.path)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        await conn.create_function("casefold", 1, _casefold, deterministic=True)
+        if read_only:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    async def open(self):
+        self.writer = await self._connect()
+        self.readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            self.readers.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        if self.readers is not None:
+            while not self.readers.empty():
+                await self.readers.get_nowait().close()
+            self.readers = None
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    @asynccontextmanager
+    async def read(self):
+        """Соединение из пула читателей (только SELECT)."""
+        conn = await self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def stream(self):
+        """
+        Отдельное соединение только для чтения на время долгой выгрузки (файл качается
+        минутами) - пул читателей остается свободным для страниц. Закрывается после выгрузки.
+        """
+        async with self.stream_slots:
+            conn = await self._connect(read_only=True)
+            try:
+                yield conn
+            finally:
+                await conn.close()
+
+    @asynccontextmanager
+    async def write(self):
+        """Единственный писатель; коммит делает вызывающий, при ошибке - откат."""
+        async with self.write_lock:
+            try:
+                yield self.writer
+            except BaseException:
+                await self.writer.rollback()
+                raise
+
+
+db = Database()
+
+
+def day_number(date_str):
+    """'2025-01-31' -> 20250131 (формат колонки events.day)."""
+    return int(date_str[:10].replace("-", ""))
+
+
+async def bump_generation(conn):
+    """Отмечает изменение данных (сбрасывает кэши страниц). Коммит - на вызывающем."""
+    await conn.execute("UPDATE meta SET generation = generation + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)")
+
+
+async def get_generation(conn):
+    """(поколение данных, unix-время последнего изменения или None)."""
+    async with conn.execute("SELECT generation, updated_at FROM meta") as cursor:
+        row = await cursor.fetchone()
+    return (row[0], row[1]) if row else (0, None)
+
+
+async def get_ranges(conn, board):
+    """Уже загруженные диапазоны id записей фракции: [(lo, hi), ...] по возрастанию."""
+    async with conn.execute(
+        "SELECT lo, hi FROM board_ranges WHERE board = ? ORDER BY lo", (board,)
+    ) as cursor:
+        return [tuple(row) for row in await cursor.fetchall()]
+
+
+async def add_ranges(conn, board, runs):
+    """
+    Отмечает отрезки id [(lo, hi), ...] загруженными, сливая их с пересекающимися
+    и соседними диапазонами (хранятся только непересекающиеся). Коммит - на вызывающем.
+    """
+    for lo, hi in runs:
+        async with conn.execute("""
+            SELECT MIN(lo), MAX(hi) FROM board_ranges WHERE board = ? AND lo <= ? AND hi >= ?
+        """, (board, hi + 1, lo - 1)) as cursor:
+            low, high = await cursor.fetchone()
+        if low is not None:
+            await conn.execute(
+                "DELETE FROM board_ranges WHERE board = ? AND lo <= ? AND hi >= ?", (board, hi + 1, lo - 1)
+            )
+            lo, hi = min(lo, low), max(hi, high)
+        await conn.execute("INSERT INTO board_ranges (board, lo, hi) VALUES (?, ?, ?)", (board, lo, hi))
+
+
+async def ledger_has(conn, digest):
+    """Был ли уже загружен файл с таким sha256."""
+    async with conn.execute("SELECT 1 FROM upload_ledger WHERE sha256 = ?", (digest,)) as cursor:
+        return await cursor.fetchone() is not None
+
+
+async def ledger_add(conn, digest, board, size, new_events):
+    """Запоминает обработанный файл. Коммит - на вызывающем."""
+    await conn.execute("""
+        INSERT OR IGNORE INTO upload_ledger (sha256, board, size, new_events) VALUES (?, ?, ?, ?)
+    """, (digest, board, size, new_events))
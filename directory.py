@@ -0,0 +1,93 @@
+import logging
+
+from consts import CLASSES
+from db import get_generation
+
+# События, где p0 (events.value) - role_id другого игрока: "... ID {p0} ..."
+TARGET_TYPES = (5, 9, 10)
+
+# Иконка и название класса для строк таблиц
+CLASS_INFO = {cid: (f"/static/icons/{cid}.png", name) for cid, (name, emoji, short) in CLASSES.items()}
+
+
+class PlayerDirectory:
+    """
+    Справочник игроков процесса: role_id -> (ник, класс, в клане).
+    Загружается при старте, правки и загрузки обновляют его сразу,
+    а изменения из других процессов (бот) подхватываются по поколению данных.
+    """
+
+    def __init__(self):
+        self.players = {}       # role_id -> (nickname или None, class_id, in_clan)
+        self.generation = None  # Поколение данных, с которым справочник сверен
+
+    async def load(self, conn):
+        generation, _ = await get_generation(conn)
+        async with conn.execute("SELECT role_id, nickname, class_id, in_clan FROM players") as cursor:
+            rows = await cursor.fetchall()
+        self.players = {rid: (nickname, cid, bool(in_clan)) for rid, nickname, cid, in_clan in rows}
+        if self.generation is None:
+            logging.info(f"👥 Справочник игроков: {len(self.players)}")
+        self.generation = generation
+
+    async def sync(self, conn):
+        """Перечитывает справочник, если данные менялись с прошлой сверки."""
+        generation, _ = await get_generation(conn)
+        if generation != self.generation:
+            await self.load(conn)
+
+    def set_nickname(self, role_id, nickname):
+        if role_id in self.players:
+            _, cid, in_clan = self.players[role_id]
+            self.players[role_id] = (nickname or None, cid, in_clan)
+
+    def set_class(self, role_id, class_id):
+        if role_id in self.players:
+            nickname, _, in_clan = self.players[role_id]
+            self.players[role_id] = (nickname, class_id, in_clan)
+
+    def name(self, role_id):
+        nickname = self.players.get(role_id, (None,))[0]
+        return nickname or f"ID {role_id}"
+
+    def info(self, role_id):
+        """Имя и класс игрока для строк таблиц (иконка и название класса или пустые строки)."""
+        nickname, cid, in_clan = self.players.get(role_id, (None, None, False))
+        icon, class_name = CLASS_INFO.get(cid, ("", ""))
+        return {
+            "name": nickname or f"ID {role_id}",
+            "class_id": cid,
+            "class_icon": icon,
+            "class_name": class_name,
+        }
+
+    def members(self, classes=None, role_ids=None):
+        """role_id игроков клана (в порядке role_id), при необходимости - только классов classes / из role_ids."""
+        classes = set(classes) if classes else None
+        pool = self.players if role_ids is None else [rid for rid in role_ids if rid in self.players]
+        return sorted(
+            rid for rid in pool
+            if self.players[rid][2] and (classes is None or self.players[rid][1] in classes)
+        )
+
+    def with_classes(self, classes):
+        """role_id всех известных игроков указанных классов (в клане и нет)."""
+        classes = set(classes)
+        return sorted(rid for rid, (_, cid, _) in self.players.items() if cid in classes)
+
+    def search(self, text):
+        """role_id игроков, в нике которых есть text (без учета регистра)."""
+        text = text.casefold()
+        return sorted(
+            rid for rid, (nickname, _, _) in self.players.items()
+            if nickname and text in nickname.casefold()
+        )
+
+    def describe(self, desc, etype, target):
+        """Описание события, где "ID {target}" заменен ником цели, если он известен."""
+        if etype not in TARGET_TYPES:
+            return desc
+        nickname = self.players.get(target, (None,))[0]
+        if not nickname:
+            return desc
+        return desc.replace(f"ID {target}", f"{nickname} (ID {target})", 1)
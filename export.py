@@ -0,0 +1,199 @@
+"""Выгрузка сводки daily_stats в CSV/XLSX потоком (общая для сайта и бота)."""
+
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from stats import STAGE_KEYS
+
+EXPORT_CHUNK = 1000  # Строк за один fetchmany
+
+EXPORT_HEADER = (
+    "Role_ID", "Ник", "Дата", "Золото", "Доблесть",
+    "Этап 1", "Этап 2", "Этап 3", "Этап 4", "Этап 5", "Этап 6", "Этап 7", "Адепты", "Танцы",
+)
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+async def export_count(conn, start_day=None, end_day=None, classes=None):
+    """Сколько строк попадет в выгрузку с такими фильтрами."""
+    where, params = _filters(start_day, end_day, classes)
+    async with conn.execute(f"""
+        SELECT COUNT(*) FROM daily_stats d
+        LEFT JOIN players p ON d.role_id = p.role_id
+        {where}
+    """, params) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+def _filters(start_day, end_day, classes):
+    conditions, params = [], []
+    if start_day is not None:
+        conditions.append("d.day >= ?")
+        params.append(start_day)
+    if end_day is not None:
+        conditions.append("d.day <= ?")
+        params.append(end_day)
+    if classes:
+        conditions.append(f"p.class_id IN ({','.join('?' * len(classes))})")
+        params.extend(classes)
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+async def export_rows(conn, start_day=None, end_day=None, classes=None, chunk=EXPORT_CHUNK):
+    """
+    Строки выгрузки (колонки EXPORT_HEADER) порциями по ~chunk штук.
+    Курсор идет по индексу дня от новых к старым, внутри дня строки
+    сортируются по золоту здесь - в памяти не больше одного дня и одной порции.
+    """
+    where, params = _filters(start_day, end_day, classes)
+    async with conn.execute(f"""
+        SELECT
+            d.day,
+            d.role_id,
+            COALESCE(p.nickname, 'Unknown ID'),
+            printf('%04d-%02d-%02d', d.day / 10000, d.day / 100 % 100, d.day % 100),
+            d.gold,
+            d.valor,
+            {", ".join(f"d.{key}" for key in STAGE_KEYS)}
+        FROM daily_stats d
+        LEFT JOIN players p ON d.role_id = p.role_id
+        {where}
+        ORDER BY d.day DESC
+    """, params) as cursor:
+        batch, day_rows, current_day = [], [], None
+        while True:
+            rows = await cursor.fetchmany(chunk)
+            for row in rows:
+                if row[0] != current_day:
+                    batch.extend(sorted(day_rows, key=lambda r: r[3], reverse=True))
+                    day_rows, current_day = [], row[0]
+                day_rows.append(row[1:])
+            if not rows:
+                batch.extend(sorted(day_rows, key=lambda r: r[3], reverse=True))
+            if batch and (len(batch) >= chunk or not rows):
+                yield batch
+                batch = []
+            if not rows:
+                break
+
+
+async def csv_stream(batches):
+    """CSV (utf-8 с BOM, разделитель ';' - открывается в Excel) из порций export_rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(EXPORT_HEADER)
+    yield "\ufeff".encode("utf-8") + buffer.getvalue().encode("utf-8")
+    async for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """Несекабельный приемник для zipfile: копит записанные байты до следующего yield."""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+# Символы, недопустимые в XML 1.0
+_XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Отчет" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        else:
+            text = escape(_XML_ILLEGAL.sub("", str(value)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+async def xlsx_stream(batches):
+    """
+    XLSX из порций export_rows: zip пишется в несекабельный приемник
+    (zipfile тогда ставит размеры в дескрипторы после данных), лист - построчно,
+    строки хранятся inline без таблицы общих строк.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in _XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetData>' + _xlsx_row(EXPORT_HEADER)
+            ).encode("utf-8"))
+            yield sink.drain()
+            async for rows in batches:
+                sheet.write("".join(_xlsx_row(row) for row in rows).encode("utf-8"))
+                data = sink.drain()
+                if data:
+                    yield data
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+
+def export_stream(fmt, batches):
+    """Поток байтов файла формата fmt ('csv' или 'xlsx')."""
+    return xlsx_stream(batches) if fmt == "xlsx" else csv_stream(batches)
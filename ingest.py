@@ -0,0 +1,260 @@
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+
+from board_parser import iter_board_batches, board_key
+from db import db, get_ranges, add_ranges, ledger_has, ledger_add, bump_generation
+from rollups import refresh
+
+# Типы событий, по которым определяется статус игрока в клане
+LEAVE_TYPES = (8,)         # "Покинул гильдию"
+ACTIVE_TYPES = (1, 2)      # Вклады доблести/золота - значит игрок внутри
+STATUS_TYPES = LEAVE_TYPES + ACTIVE_TYPES
+ROLLUP_TYPES = (1, 2)      # Вклады: этап в events.stage и сводка daily_stats
+
+
+def file_digest(data):
+    """sha256 содержимого файла - ключ журнала загрузок."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def duplicate_result():
+    return {"total_parsed": 0, "new_events": 0, "new_players": 0, "had_ranges": False, "duplicate": True}
+
+
+async def ingest_file(conn, data, filename):
+    """
+    Загружает содержимое файла FactionBoard (bytes) в БД одной транзакцией.
+    Игроки и события пишутся через executemany пачками, статус в клане
+    вычисляется в памяти (побеждает самое позднее событие) и обновляется в конце,
+    если в базе нет события статуса новее.
+    Файлы, уже записанные в журнал загрузок, не разбираются вовсе.
+    Возвращает словарь со счетчиками: total_parsed, new_events, new_players
+    и roles - игроки, чья сводка daily_stats изменилась.
+    """
+    digest = file_digest(data)
+    if await ledger_has(conn, digest):
+        return duplicate_result()
+
+    board = board_key(filename)
+    covered = await get_ranges(conn, board)
+    parsed = await asyncio.to_thread(prepare_file, data, covered)
+    return await write_parsed(conn, parsed, board, bool(covered), ledger=(digest, len(data)))
+
+
+def id_runs(ids):
+    """Непрерывные отрезки [(lo, hi), ...] из набора id."""
+    runs = []
+    for rid in sorted(ids):
+        if runs and rid == runs[-1][1] + 1:
+            runs[-1][1] = rid
+        elif not runs or rid > runs[-1][1]:
+            runs.append([rid, rid])
+    return [tuple(run) for run in runs]
+
+
+def prepare_file(data, covered=None, batch_size=1024):
+    """
+    Разбор файла и подготовка всего, что пишется в БД: строки events (с датой,
+    днем и описанием), статусы в клане, окна вкладов и отрезки id.
+    Чистый CPU без БД - вызывается в потоке, писатель получает готовые пачки.
+    """
+    seen_ids = set()
+    batches = []     # (строки events, role_id игроков пачки)
+    membership = {}  # role_id -> (timestamp, in_clan)
+    windows = {}     # role_id -> (min_ts, max_ts) новых вкладов
+    total = 0
+
+    for batch in iter_board_batches(data, batch_size, covered):
+        total += len(batch)
+        events = []
+        for rec in batch:
+            seen_ids.add(rec.id)
+
+            if rec.type in LEAVE_TYPES:
+                status = 0
+            elif rec.type in ACTIVE_TYPES:
+                status = 1
+            else:
+                status = None
+            if status is not None:
+                prev = membership.get(rec.role_id)
+                if prev is None or rec.timestamp >= prev[0]:
+                    membership[rec.role_id] = (rec.timestamp, status)
+            if rec.type in ROLLUP_TYPES:
+                lo, hi = windows.get(rec.role_id, (rec.timestamp, rec.timestamp))
+                windows[rec.role_id] = (min(lo, rec.timestamp), max(hi, rec.timestamp))
+
+            events.append((rec.role_id, rec.timestamp, rec.date, rec.day, rec.type, rec.p0, rec.description))
+        batches.append((events, {rec.role_id for rec in batch}))
+
+    return {
+        "total": total,
+        "batches": batches,
+        "membership": membership,
+        "windows": windows,
+        "ranges": id_runs(seen_ids),
+    }
+
+
+async def write_parsed(conn, parsed, board, had_ranges, ledger=None):
+    """
+    Пишет подготовленный prepare_file разбор: игроков и события пачками,
+    классифицирует этапы новых вкладов (и соседей в окне танца), пересчитывает
+    сводку daily_stats по затронутым дням и отмечает id записей как загруженные
+    (board_ranges), затем commit.
+    had_ranges - были ли у фракции загруженные диапазоны до этого файла.
+    ledger - (sha256, размер) файла для журнала загрузок.
+    """
+    total = parsed["total"]
+    membership = parsed["membership"]
+    windows = parsed["windows"]
+    new_events = 0
+    new_players = 0
+
+    for events, roles in parsed["batches"]:
+        # По умолчанию считаем, что если игрок в логах - он был в клане
+        before = conn.total_changes
+        await conn.executemany(
+            "INSERT OR IGNORE INTO players (role_id, in_clan) VALUES (?, 1)",
+            [(rid,) for rid in roles]
+        )
+        new_players += conn.total_changes - before
+
+        before = conn.total_changes
+        await conn.executemany("""
+            INSERT INTO events (role_id, timestamp, event_date, day, event_type, value, raw_desc)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, events)
+        new_events += conn.total_changes - before
+
+    if membership:
+        # Статус из файла применяется, только если в базе нет более позднего события
+        # статуса: старый архив или повторная отправка не возвращают ушедшего в клан
+        await conn.executemany(f"""
+            UPDATE players SET in_clan = ?
+            WHERE role_id = ? AND ? >= (
+                SELECT MAX(timestamp) FROM events
+                WHERE role_id = ? AND event_type IN ({",".join(map(str, STATUS_TYPES))})
+            )
+        """, [(status, rid, ts, rid) for rid, (ts, status) in membership.items()])
+    if windows:
+        await refresh(conn, windows)
+
+    if parsed["ranges"]:
+        await add_ranges(conn, board, parsed["ranges"])
+    if ledger and (total or had_ranges):
+        digest, size = ledger
+        await ledger_add(conn, digest, board, size, new_events)
+    if total:
+        await bump_generation(conn)
+    await conn.commit()
+
+    return {
+        "total_parsed": total,
+        "new_events": new_events,
+        "new_players": new_players,
+        "had_ranges": had_ranges,
+        "duplicate": False,
+        "roles": list(windows),
+    }
+
+
+class IngestQueue:
+    """
+    Фоновая очередь загрузок для веб-сервера.
+    Несколько воркеров разбирают файлы (в потоках), а в БД пишет
+    одна задача через соединение-писатель - записи идут строго по очереди.
+    on_commit(conn, roles) - вызывается писателем после каждой записанной загрузки.
+    """
+
+    JOB_TTL = 3600  # Сколько секунд помним завершенные задачи
+
+    def __init__(self, parse_workers=2, max_pending=64, on_commit=None):
+        self.parse_workers = parse_workers
+        self.on_commit = on_commit
+        self.pending = asyncio.Queue(maxsize=max_pending)
+        self.parsed = asyncio.Queue(maxsize=max_pending)
+        self.jobs = {}
+        self.tasks = []
+
+    async def start(self):
+        self.tasks = [asyncio.create_task(self._parse_worker()) for _ in range(self.parse_workers)]
+        self.tasks.append(asyncio.create_task(self._writer()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, data, filename, digest=None):
+        """Ставит файл в очередь. Возвращает job_id или None, если очередь переполнена."""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        try:
+            self.pending.put_nowait((job_id, data, filename, digest or file_digest(data)))
+        except asyncio.QueueFull:
+            return None
+        self.jobs[job_id] = {"state": "queued", "filename": filename, "updated": time.time()}
+        return job_id
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _set(self, job_id, **fields):
+        fields["updated"] = time.time()
+        self.jobs[job_id].update(fields)
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job["state"] in ("done", "error") and now - job["updated"] > self.JOB_TTL:
+                del self.jobs[job_id]
+
+    async def _parse_worker(self):
+        while True:
+            job_id, data, filename, digest = await self.pending.get()
+            try:
+                self._set(job_id, state="parsing")
+                board = board_key(filename)
+                async with db.read() as conn:
+                    if await ledger_has(conn, digest):
+                        self._set(job_id, state="done", **duplicate_result())
+                        continue
+                    covered = await get_ranges(conn, board)
+                # Разбор, даты и описания событий - в потоке, писателю остаются только запросы
+                parsed = await asyncio.to_thread(prepare_file, data, covered)
+                ledger = (digest, len(data))
+                await self.parsed.put((job_id, parsed, board, bool(covered), ledger))
+            except Exception as e:
+                logging.error(f"Ошибка разбора {filename}: {e}")
+                self._set(job_id, state="error", message=str(e))
+            finally:
+                self.pending.task_done()
+
+    async def _writer(self):
+        while True:
+            job_id, parsed, board, had_ranges, ledger = await self.parsed.get()
+            try:
+                self._set(job_id, state="writing")
+                async with db.write() as conn:
+                    # Тот же файл мог прийти параллельно и уже записаться
+                    if await ledger_has(conn, ledger[0]):
+                        result = duplicate_result()
+                    else:
+                        result = await write_parsed(conn, parsed, board, had_ranges, ledger)
+                        if self.on_commit:
+                            await self.on_commit(conn, result["roles"])
+                result.pop("roles", None)
+                if not result["total_parsed"] and not result["had_ranges"] and not result["duplicate"]:
+                    self._set(job_id, state="error", message="File empty or data too old")
+                else:
+                    self._set(job_id, state="done", **result)
+            except Exception as e:
+                logging.error(f"Ошибка записи {board}: {e}")
+                self._set(job_id, state="error", message=str(e))
+            finally:
+                self.parsed.task_done()
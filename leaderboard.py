@@ -0,0 +1,102 @@
+import logging
+
+import numpy as np
+
+from db import get_generation
+from rollups import ROLLUP_COLUMNS
+
+DAY_SPAN = 10 ** 8  # Ключ строки: позиция игрока * DAY_SPAN + день (YYYYMMDD < 10^8)
+
+
+class LeaderboardIndex:
+    """
+    Префиксные суммы daily_stats в памяти: итоги игрока за любой период [start, end]
+    считаются как разность двух накопленных сумм (два searchsorted на всех игроков сразу),
+    поэтому цена запроса не зависит от длины периода.
+    Строится из daily_stats при старте и дополняется после каждой загрузки;
+    изменения мимо этого процесса (бот, фоновые миграции, rollups.py --rebuild)
+    подхватываются по поколению данных.
+    """
+
+    def __init__(self):
+        self.roles = np.empty(0, dtype=np.int64)           # role_id строк, отсортированы
+        self.days = np.empty(0, dtype=np.int64)
+        self.values = np.empty((0, len(ROLLUP_COLUMNS)), dtype=np.int64)
+        self.role_ids = np.empty(0, dtype=np.int64)        # уникальные role_id
+        self.keys = np.empty(0, dtype=np.int64)
+        self.cum = np.zeros((1, len(ROLLUP_COLUMNS)), dtype=np.int64)
+        self.generation = None  # Поколение данных, с которым индекс сверен
+
+    async def _fetch(self, conn, where="", params=()):
+        async with conn.execute(f"""
+            SELECT role_id, day, {", ".join(ROLLUP_COLUMNS)} FROM daily_stats {where}
+        """, params) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            return np.empty((0, len(ROLLUP_COLUMNS) + 2), dtype=np.int64)
+        return np.array(rows, dtype=np.int64)
+
+    def _set_rows(self, roles, days, values):
+        order = np.lexsort((days, roles))
+        self.roles, self.days, self.values = roles[order], days[order], values[order]
+        self.role_ids, positions = np.unique(self.roles, return_inverse=True)
+        self.keys = positions.astype(np.int64) * DAY_SPAN + self.days
+        self.cum = np.zeros((len(self.roles) + 1, len(ROLLUP_COLUMNS)), dtype=np.int64)
+        np.cumsum(self.values, axis=0, out=self.cum[1:])
+
+    async def load(self, conn):
+        """Полная пересборка индекса из daily_stats."""
+        generation, _ = await get_generation(conn)
+        rows = await self._fetch(conn)
+        self._set_rows(rows[:, 0], rows[:, 1], rows[:, 2:])
+        self.generation = generation
+        logging.info(f"📊 Индекс лидерборда: {len(self.role_ids)} игроков, {len(self.roles)} дней")
+
+    async def update_roles(self, conn, roles):
+        """
+        Заменяет строки игроков roles свежими из daily_stats (после загрузки,
+        которая подняла поколение ровно на 1). Если поколение ушло дальше -
+        данные менял кто-то еще, и индекс остается несверенным до sync.
+        """
+        if self.generation is None:
+            return
+        roles = list(roles)
+        if roles:
+            placeholders = ",".join("?" * len(roles))
+            fresh = await self._fetch(conn, f"WHERE role_id IN ({placeholders})", roles)
+            keep = ~np.isin(self.roles, np.array(roles, dtype=np.int64))
+            self._set_rows(
+                np.concatenate([self.roles[keep], fresh[:, 0]]),
+                np.concatenate([self.days[keep], fresh[:, 1]]),
+                np.concatenate([self.values[keep], fresh[:, 2:]]),
+            )
+            generation, _ = await get_generation(conn)
+            if generation == self.generation + 1:
+                self.generation = generation
+
+    async def sync(self, conn):
+        """Перечитывает индекс, если данные менялись мимо update_roles."""
+        generation, _ = await get_generation(conn)
+        if generation != self.generation:
+            await self.load(conn)
+
+    def totals(self, start_day, end_day, role_ids):
+        """
+        Итоги за [start_day, end_day] для role_ids: {role_id: {колонка: сумма}}.
+        Игроки без строк в daily_stats получают нули.
+        """
+        role_ids = np.asarray(role_ids, dtype=np.int64)
+        if not len(self.role_ids):
+            sums = np.zeros((len(role_ids), len(ROLLUP_COLUMNS)), dtype=np.int64)
+        else:
+            pos = np.minimum(np.searchsorted(self.role_ids, role_ids), len(self.role_ids) - 1)
+            base = pos.astype(np.int64) * DAY_SPAN
+            lo = np.searchsorted(self.keys, base + start_day, side="left")
+            hi = np.searchsorted(self.keys, base + end_day, side="right")
+            sums = self.cum[hi] - self.cum[lo]
+            sums[self.role_ids[pos] != role_ids] = 0
+
+        return {
+            rid: dict(zip(ROLLUP_COLUMNS, row))
+            for rid, row in zip(role_ids.tolist(), sums.tolist())
+        }
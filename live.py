@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+
+def sse(event, data):
+    """Одно сообщение Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class LiveBroker:
+    """
+    Подписчики живых обновлений (открытые страницы) и их фильтры.
+    Запись в БД будит рассылку через notify(); каждому подписчику
+    сообщение строится отдельно - под его период и классы.
+    """
+
+    MAX_BACKLOG = 32  # Подписчик, не забирающий сообщения, отключается
+
+    def __init__(self):
+        self.subscribers = {}  # asyncio.Queue -> фильтры страницы
+        self.changed = asyncio.Event()
+
+    def subscribe(self, filters):
+        queue = asyncio.Queue()
+        self.subscribers[queue] = filters
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.pop(queue, None)
+
+    def is_subscribed(self, queue):
+        return queue in self.subscribers
+
+    def notify(self):
+        """Данные изменились в этом процессе - разослать, не дожидаясь опроса."""
+        self.changed.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.changed.clear()
+
+    async def publish(self, build):
+        """build(filters) -> сообщение или None (подписчику нечего показывать)."""
+        for queue, filters in list(self.subscribers.items()):
+            message = await build(filters)
+            if message is None:
+                continue
+            if queue.qsize() >= self.MAX_BACKLOG:
+                self.unsubscribe(queue)
+                continue
+            queue.put_nowait(message)
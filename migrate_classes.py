@@ -1,18 +1,20 @@
 import asyncio
-import aiosqlite
 
-DB_NAME = "clan_archive.db"
+from db import db, DB_NAME
+from migrations import migrate, run_backfills, get_version
 
-async def migrate():
+# Ручной запуск миграций (без старта бота/сайта): схема + все фоновые заполнения сразу.
+
+async def main():
     print(f"Connecting to {DB_NAME}...")
-    async with aiosqlite.connect(DB_NAME) as conn:
-        cursor = await conn.cursor()
-        try:
-            await cursor.execute("ALTER TABLE players ADD COLUMN class_id INTEGER DEFAULT -1")
-            print("✅ Added 'class_id' column to 'players' table.")
-            await conn.commit()
-        except Exception as e:
-            print(f"ℹ️ {e} (Column might already exist)")
+    await db.open()
+    try:
+        await migrate(db)
+        await run_backfills(db)
+        async with db.read() as conn:
+            print(f"✅ Schema version: {await get_version(conn)}")
+    finally:
+        await db.close()
 
 if __name__ == "__main__":
-    asyncio.run(migrate())
+    asyncio.run(main())
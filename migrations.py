@@ -0,0 +1,293 @@
+import asyncio
+import logging
+
+from db import bump_generation
+from rollups import rebuild_roles
+
+# Версия схемы хранится в PRAGMA user_version. Каждый шаг - (версия, описание, функция),
+# шаги применяются строго по порядку, каждый в своей транзакции.
+# Шаги должны быть быстрыми: тяжелая работа по большим таблицам - в BACKFILLS.
+
+BACKFILL_CHUNK = 5000  # Строк за одну транзакцию фоновой миграции
+
+
+async def _columns(conn, table):
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+
+async def _add_column(conn, table, column, decl):
+    """ALTER TABLE ADD COLUMN, только если колонки еще нет (старые базы)."""
+    if column not in await _columns(conn, table):
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        logging.info(f"🛠 Добавлена колонка {column} в таблицу {table}")
+
+
+async def _v1_base(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS players (
+            role_id INTEGER PRIMARY KEY,
+            nickname TEXT DEFAULT NULL,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            in_clan INTEGER DEFAULT 1,
+            class_id INTEGER DEFAULT -1
+        )
+    """)
+    # Базы первых версий создавались без этих колонок
+    await _add_column(conn, "players", "in_clan", "INTEGER DEFAULT 1")
+    await _add_column(conn, "players", "class_id", "INTEGER DEFAULT -1")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role_id INTEGER,
+            timestamp INTEGER,
+            event_date TEXT,
+            event_type INTEGER,
+            value INTEGER,
+            raw_desc TEXT,
+            UNIQUE(role_id, timestamp, event_type) ON CONFLICT IGNORE
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_date ON events (event_date)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_type ON events (event_type)")
+
+
+async def _v2_upload_tracking(conn):
+    # Водяные знаки: последний загруженный id записи по каждой фракции
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS board_watermarks (
+            board TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL
+        )
+    """)
+    # Журнал загрузок: хэш содержимого уже обработанных файлов
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_ledger (
+            sha256 TEXT PRIMARY KEY,
+            board TEXT,
+            size INTEGER,
+            new_events INTEGER,
+            uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def _v3_event_day(conn):
+    # Числовой день (YYYYMMDD) вместо substr(event_date) в фильтрах.
+    # Сама колонка добавляется сразу, заполнение и индексы - фоном (backfill "event_day")
+    await _add_column(conn, "events", "day", "INTEGER")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_backfills (
+            name TEXT PRIMARY KEY,
+            done_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def _v4_daily_stats(conn):
+    # Сводка по игроку за день, обновляется при загрузке (см. rollups.py).
+    # Для уже загруженных событий заполняется фоном (backfill "daily_stats")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            role_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            gold INTEGER NOT NULL DEFAULT 0,
+            valor INTEGER NOT NULL DEFAULT 0,
+            s1 INTEGER NOT NULL DEFAULT 0,
+            s2 INTEGER NOT NULL DEFAULT 0,
+            s3 INTEGER NOT NULL DEFAULT 0,
+            s4 INTEGER NOT NULL DEFAULT 0,
+            s5 INTEGER NOT NULL DEFAULT 0,
+            s6 INTEGER NOT NULL DEFAULT 0,
+            s7 INTEGER NOT NULL DEFAULT 0,
+            adepts INTEGER NOT NULL DEFAULT 0,
+            dances INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (role_id, day)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_day ON daily_stats (day)")
+
+
+async def _v5_event_stage(conn):
+    # Этап КХ каждого вклада (s1..s7, adepts, dances), считается при загрузке.
+    # Для уже загруженных событий - фоном (backfill "event_stage")
+    await _add_column(conn, "events", "stage", "TEXT")
+
+
+async def _v6_meta(conn):
+    # Счетчик поколений данных: растет при каждой записи (загрузка, ник, класс).
+    # По нему сбрасываются кэши страниц, в т.ч. в другом процессе (бот пишет в ту же базу)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            generation INTEGER NOT NULL DEFAULT 0,
+            updated_at INTEGER
+        )
+    """)
+    await conn.execute("INSERT OR IGNORE INTO meta (id, generation, updated_at) SELECT 1, 0, MAX(timestamp) FROM events")
+
+
+async def _v7_board_ranges(conn):
+    # Вместо одного водяного знака на фракцию - все загруженные диапазоны id записей:
+    # старый архив после нового и записи за to_id заголовка больше не теряются.
+    # Нижняя граница старых водяных знаков неизвестна, поэтому они не переносятся:
+    # повторно прочитанные записи отсекает UNIQUE в events
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS board_ranges (
+            board TEXT NOT NULL,
+            lo INTEGER NOT NULL,
+            hi INTEGER NOT NULL,
+            PRIMARY KEY (board, lo)
+        ) WITHOUT ROWID
+    """)
+    await conn.execute("DROP TABLE IF EXISTS board_watermarks")
+
+
+MIGRATIONS = [
+    (1, "Игроки и события", _v1_base),
+    (2, "Водяные знаки и журнал загрузок", _v2_upload_tracking),
+    (3, "Колонка events.day", _v3_event_day),
+    (4, "Сводка daily_stats", _v4_daily_stats),
+    (5, "Колонка events.stage", _v5_event_stage),
+    (6, "Счетчик поколений данных", _v6_meta),
+    (7, "Загруженные диапазоны id по фракциям", _v7_board_ranges),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def _backfill_event_day(conn, position):
+    """
+    Одна порция заполнения events.day: следующие BACKFILL_CHUNK строк по id после position.
+    Идем по первичному ключу, а не по day IS NULL - каждая порция не пересматривает таблицу с начала.
+    """
+    async with conn.execute("""
+        SELECT MAX(id), COUNT(*) FROM (SELECT id FROM events WHERE id > ? ORDER BY id LIMIT ?)
+    """, (position or 0, BACKFILL_CHUNK)) as cursor:
+        last_id, count = await cursor.fetchone()
+    if not count:
+        return 0, None
+    cursor = await conn.execute("""
+        UPDATE events SET day = CAST(replace(substr(event_date, 1, 10), '-', '') AS INTEGER)
+        WHERE id > ? AND id <= ? AND day IS NULL
+          AND event_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+    """, (position or 0, last_id))
+    return cursor.rowcount, (last_id if count == BACKFILL_CHUNK else None)
+
+
+async def _index_event_day(conn):
+    # Индексы строим после заполнения: так быстрее, чем обновлять их построчно
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_type_day_role ON events (event_type, day, role_id)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_day_ts ON events (day, timestamp)")
+
+
+async def _backfill_event_stage(conn, position):
+    return await rebuild_roles(conn, position)
+
+
+async def _backfill_daily_stats(conn, position):
+    return await rebuild_roles(conn, position, classify=False)
+
+
+# Фоновые миграции: (имя, версия схемы, порция, завершение или None).
+# Порция - chunk(conn, позиция) -> (число строк, следующая позиция или None в конце);
+# первый вызов с позицией None. Завершение вызывается один раз после последней порции.
+BACKFILLS = [
+    ("event_day", 3, _backfill_event_day, _index_event_day),
+    ("event_stage", 5, _backfill_event_stage, None),
+    ("daily_stats", 4, _backfill_daily_stats, None),
+]
+
+
+async def get_version(conn):
+    async with conn.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(database):
+    """
+    Доводит схему до SCHEMA_VERSION. Если схема актуальна - ничего не делает.
+    Бот и веб-сервер могут стартовать одновременно: версия перечитывается
+    под BEGIN IMMEDIATE, поэтому каждый шаг применит только один процесс.
+    """
+    async with database.write() as conn:
+        if await get_version(conn) >= SCHEMA_VERSION:
+            return
+        for version, title, step in MIGRATIONS:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                if await get_version(conn) >= version:
+                    await conn.rollback()
+                    continue
+                await step(conn)
+                await conn.execute(f"PRAGMA user_version = {version}")
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+            logging.info(f"🛠 Миграция {version}: {title}")
+
+
+async def backfill_done(conn, name):
+    """Завершена ли фоновая миграция name (например, заполнена ли сводка daily_stats)."""
+    async with conn.execute("SELECT 1 FROM schema_backfills WHERE name = ?", (name,)) as cursor:
+        return await cursor.fetchone() is not None
+
+
+async def pending_backfills(database):
+    """Имена фоновых миграций, которые еще не завершены."""
+    async with database.read() as conn:
+        version = await get_version(conn)
+        if version < 3:
+            return []
+        async with conn.execute("SELECT name FROM schema_backfills") as cursor:
+            done = {row[0] for row in await cursor.fetchall()}
+    return [name for name, min_version, _, _ in BACKFILLS if name not in done and version >= min_version]
+
+
+async def run_backfills(database):
+    """
+    Выполняет фоновые миграции порциями по BACKFILL_CHUNK строк.
+    Писатель отпускается между порциями, так что загрузки и правки не ждут
+    окончания миграции. Прерванная миграция продолжится при следующем старте.
+    """
+    pending = await pending_backfills(database)
+    for name, _, chunk, finish in BACKFILLS:
+        if name not in pending:
+            continue
+        logging.info(f"🛠 Фоновая миграция {name}...")
+        total = 0
+        position = None
+        while True:
+            async with database.write() as conn:
+                updated, position = await chunk(conn, position)
+                await conn.commit()
+            total += updated
+            if position is None:
+                break
+            await asyncio.sleep(0)
+        async with database.write() as conn:
+            if finish:
+                await finish(conn)
+            await conn.execute("INSERT OR IGNORE INTO schema_backfills (name) VALUES (?)", (name,))
+            await bump_generation(conn)
+            await conn.commit()
+        logging.info(f"🛠 Фоновая миграция {name} завершена ({total} строк)")
+    return len(pending)
+
+
+def start_backfills(database, on_done=None):
+    """
+    Запускает фоновые миграции задачей, не блокируя старт. Ошибки только логируются.
+    on_done - корутина, которая вызывается, если какая-то миграция была выполнена.
+    """
+    async def runner():
+        try:
+            if await run_backfills(database) and on_done:
+                await on_done()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка фоновой миграции: {e}")
+    return asyncio.create_task(runner())
@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import logging
+from datetime import datetime
+
+from db import bump_generation
+from stats import classify_events, classify_batch, DANCE_WINDOW, STAGE_KEYS
+
+# Сводка по игроку за день: суммы вкладов и число этапов.
+# Этап каждого вклада хранится в events.stage и считается при загрузке,
+# сводка daily_stats - обычный GROUP BY по events.
+# Таблицы создаются миграциями, здесь - только заполнение.
+ROLLUP_COLUMNS = ("gold", "valor") + STAGE_KEYS
+
+REBUILD_ROLES_CHUNK = 200  # Игроков за одну транзакцию при полной пересборке
+
+_AGGREGATE_SQL = f"""
+    INSERT OR REPLACE INTO daily_stats (role_id, day, {", ".join(ROLLUP_COLUMNS)})
+    SELECT role_id, day,
+        SUM(CASE WHEN event_type = 2 THEN value ELSE 0 END),
+        SUM(CASE WHEN event_type = 1 THEN value ELSE 0 END),
+        {", ".join(f"COUNT(CASE WHEN stage = '{key}' THEN 1 END)" for key in STAGE_KEYS)}
+    FROM events
+    WHERE event_type IN (1, 2) AND day IS NOT NULL AND {{where}}
+    GROUP BY role_id, day
+"""
+
+
+def touched_days(ts):
+    """Дни, сводку которых может изменить вклад в момент ts (с учетом окна танца)."""
+    return {
+        int(datetime.fromtimestamp(t).strftime("%Y%m%d"))
+        for t in (ts - DANCE_WINDOW, ts, ts + DANCE_WINDOW)
+    }
+
+
+async def classify_range(conn, role_id, lo, hi):
+    """
+    Пересчитывает events.stage для вкладов игрока с timestamp в [lo, hi].
+    Соседи берутся с запасом DANCE_WINDOW: более дальние на танец не влияют.
+    Пишутся только изменившиеся этапы. Возвращает число обновленных событий.
+    """
+    async with conn.execute("""
+        SELECT id, timestamp, value, event_type, stage FROM events
+        WHERE role_id = ? AND event_type IN (1, 2) AND timestamp >= ? AND timestamp <= ?
+        ORDER BY timestamp, event_type, id
+    """, (role_id, lo - DANCE_WINDOW, hi + DANCE_WINDOW)) as cursor:
+        rows = await cursor.fetchall()
+
+    stages = classify_events([(ts, val, etype) for _, ts, val, etype, _ in rows])
+    changed = [
+        (stage, eid)
+        for (eid, ts, _, _, old), stage in zip(rows, stages)
+        if lo <= ts <= hi and stage != old
+    ]
+    if changed:
+        await conn.executemany("UPDATE events SET stage = ? WHERE id = ?", changed)
+    return len(changed)
+
+
+async def refresh(conn, windows):
+    """
+    Обновление после загрузки: windows - {role_id: (min_ts, max_ts)} новых вкладов.
+    Переклассифицирует только окно ±DANCE_WINDOW вокруг них (поздно пришедший сосед
+    может превратить чужой вклад 4 в танец) и пересобирает сводку затронутых дней.
+    Вызывается в транзакции загрузки, коммит - на вызывающем.
+    """
+    for role_id, (min_ts, max_ts) in windows.items():
+        await classify_range(conn, role_id, min_ts - DANCE_WINDOW, max_ts + DANCE_WINDOW)
+        days = sorted(touched_days(min_ts) | touched_days(max_ts))
+        # Окно может накрывать много дней (первая загрузка) - берем весь диапазон
+        await conn.execute(
+            _AGGREGATE_SQL.format(where="role_id = ? AND day BETWEEN ? AND ?"),
+            (role_id, days[0], days[-1])
+        )
+
+
+async def classify_roles(conn, roles, placeholders):
+    """Пересчитывает events.stage для всех вкладов игроков roles одним векторным проходом."""
+    async with conn.execute(f"""
+        SELECT id, role_id, timestamp, value, event_type, stage FROM events
+        WHERE role_id IN ({placeholders}) AND event_type IN (1, 2)
+        ORDER BY role_id, timestamp, event_type, id
+    """, roles) as cursor:
+        rows = await cursor.fetchall()
+    if not rows:
+        return 0
+
+    ids, role_ids, ts, values, types, old = zip(*rows)
+    codes = classify_batch(role_ids, ts, values, types).tolist()
+    changed = [
+        (STAGE_KEYS[code] if code >= 0 else None, eid)
+        for eid, code, prev in zip(ids, codes, old)
+        if (STAGE_KEYS[code] if code >= 0 else None) != prev
+    ]
+    if changed:
+        await conn.executemany("UPDATE events SET stage = ? WHERE id = ?", changed)
+    return len(changed)
+
+
+async def rebuild_roles(conn, after_role=None, classify=True):
+    """
+    Пересобирает этапы (classify) и сводку для следующих REBUILD_ROLES_CHUNK игроков
+    по возрастанию role_id. Возвращает (число строк сводки, последний role_id)
+    или (0, None), если игроки кончились.
+    """
+    async with conn.execute("""
+        SELECT DISTINCT role_id FROM events
+        WHERE event_type IN (1, 2) AND role_id > ?
+        ORDER BY role_id LIMIT ?
+    """, (after_role if after_role is not None else -2**31, REBUILD_ROLES_CHUNK)) as cursor:
+        roles = [row[0] for row in await cursor.fetchall()]
+    if not roles:
+        return 0, None
+
+    placeholders = ",".join("?" * len(roles))
+    if classify:
+        await classify_roles(conn, roles, placeholders)
+
+    await conn.execute(f"DELETE FROM daily_stats WHERE role_id IN ({placeholders})", roles)
+    cursor = await conn.execute(_AGGREGATE_SQL.format(where=f"role_id IN ({placeholders})"), roles)
+    return cursor.rowcount, roles[-1]
+
+
+async def rebuild(database):
+    """Полная пересборка этапов и daily_stats из events (порциями, писатель отпускается между ними)."""
+    async with database.write() as conn:
+        await conn.execute("DELETE FROM daily_stats")
+        await conn.commit()
+
+    total = 0
+    last_role = None
+    while True:
+        async with database.write() as conn:
+            written, last_role = await rebuild_roles(conn, last_role)
+            await conn.commit()
+        if last_role is None:
+            break
+        total += written
+        await asyncio.sleep(0)
+    async with database.write() as conn:
+        await bump_generation(conn)
+        await conn.commit()
+    logging.info(f"📊 Сводка daily_stats пересобрана: {total} строк")
+    return total
+
+
+async def main():
+    from db import db, DB_NAME
+    from migrations import migrate
+
+    parser = argparse.ArgumentParser(description="Обслуживание сводной таблицы daily_stats")
+    parser.add_argument("--rebuild", action="store_true", help="пересчитать этапы и daily_stats из events")
+    args = parser.parse_args()
+    if not args.rebuild:
+        parser.print_help()
+        return
+
+    print(f"Connecting to {DB_NAME}...")
+    await db.open()
+    try:
+        await migrate(db)
+        total = await rebuild(db)
+        print(f"✅ daily_stats rebuilt: {total} rows")
+    finally:
+        await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import date, timedelta
+
+from fastapi.staticfiles import StaticFiles
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_URL = "/snapshots"
+
+# Файлы с хэшем содержимого в имени никогда не меняются - кэшируются навсегда
+IMMUTABLE = "public, max-age=31536000, immutable"
+_HASHED_NAME = re.compile(r"-[0-9a-f]{16}\.json$")
+
+
+def snapshot_ranges(today=None):
+    """Частые периоды страницы: {имя: (start, end)} в формате YYYY-MM-DD."""
+    today = today or date.today()
+    monday = today - timedelta(days=today.weekday())
+    prev_monday = monday - timedelta(days=7)
+    return {
+        "week": (monday.isoformat(), today.isoformat()),
+        "prev_week": (prev_monday.isoformat(), (monday - timedelta(days=1)).isoformat()),
+        "month": (today.replace(day=1).isoformat(), today.isoformat()),
+    }
+
+
+def _write_atomic(path, data):
+    """Пишет во временный файл рядом и подменяет - читатель видит старый или новый файл целиком."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class SnapshotFiles(StaticFiles):
+    """Раздача каталога снимков: файлы с хэшем - с долгим кэшем, manifest.json и index.html - с проверкой."""
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = IMMUTABLE if _HASHED_NAME.search(path) else "no-cache"
+        return response
+
+
+class SnapshotStore:
+    """
+    Готовые ответы /api/stats для частых периодов (все классы) в каталоге статики.
+    Пересобираются после изменения данных (поколение meta) или смены дня;
+    страница с таким периодом берет итоги из снимка, а не из БД.
+    """
+
+    def __init__(self, directory=SNAPSHOT_DIR):
+        self.directory = directory
+        self.manifest = None   # Последний записанный manifest.json
+        self.previous = set()  # Файлы прошлого набора: их могут еще дочитывать открытые страницы
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        self.changed.set()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.changed.clear()
+
+    def is_current(self, generation, today=None):
+        today = today or date.today()
+        return (
+            self.manifest is not None
+            and self.manifest["generation"] == generation
+            and self.manifest["date"] == today.isoformat()
+        )
+
+    def url_for(self, generation, start, end, classes=None):
+        """URL снимка для периода или None (другие фильтры или снимок устарел)."""
+        if classes or not self.is_current(generation):
+            return None
+        for entry in self.manifest["ranges"].values():
+            if entry["start"] == start and entry["end"] == end:
+                return f"{SNAPSHOT_URL}/{entry['file']}"
+        return None
+
+    def _load_previous(self):
+        """После перезапуска прошлым набором считаются файлы из manifest.json на диске."""
+        try:
+            with open(os.path.join(self.directory, "manifest.json"), encoding="utf-8") as f:
+                return {entry["file"] for entry in json.load(f)["ranges"].values()}
+        except (OSError, ValueError, KeyError):
+            return set()
+
+    def _put(self, name, body):
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        filename = f"stats-{name}-{digest}.json"
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            _write_atomic(path, body)
+        return filename
+
+    async def rebuild(self, generation, build, render_page=None):
+        """
+        build(start, end) -> тело JSON (bytes) для периода; render_page(url) -> HTML страницы
+        периода по умолчанию (неделя) или None. Файлы пишутся атомарно, manifest - последним.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if self.manifest is None:
+            self.previous = self._load_previous()
+        today = date.today()
+        ranges = {}
+        for name, (start, end) in snapshot_ranges(today).items():
+            body = await build(start, end)
+            ranges[name] = {"start": start, "end": end, "file": self._put(name, body)}
+
+        manifest = {"generation": generation, "date": today.isoformat(), "ranges": ranges}
+        current = {entry["file"] for entry in ranges.values()}
+        # HTML раньше манифеста, но уже со ссылкой на новый снимок
+        if render_page is not None:
+            html = render_page(f"{SNAPSHOT_URL}/{ranges['week']['file']}")
+            _write_atomic(os.path.join(self.directory, "index.html"), html.encode("utf-8"))
+        _write_atomic(
+            os.path.join(self.directory, "manifest.json"),
+            json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"),
+        )
+        self.manifest = manifest
+
+        # Убираем снимки старше прошлого набора
+        for filename in os.listdir(self.directory):
+            if _HASHED_NAME.search(filename) and filename not in current and filename not in self.previous:
+                os.remove(os.path.join(self.directory, filename))
+        self.previous = current
+        logging.info(f"🗂️ Снимки обновлены (поколение {generation})")
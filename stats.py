@@ -0,0 +1,138 @@
+"""Подсчет статистики КХ по вкладам доблести/золота (общий для сайта, бота и сводок)."""
+
+import numpy as np
+
+# Доблесть за этап КХ -> колонка статистики
+STAGE_BY_VALOR = {
+    4: "s1", 6: "s2", 10: "s3", 14: "s4", 24: "s5", 40: "s6", 70: "s7",
+    7: "adepts",
+    2: "dances", 8: "dances",
+}
+STAGE_KEYS = ("s1", "s2", "s3", "s4", "s5", "s6", "s7", "adepts", "dances")
+
+DANCE_WINDOW = 1200  # Танец: вклад 4 рядом (< 20 мин) со вкладом 2 до или 8 после
+
+
+def empty_stats():
+    stats = {key: 0 for key in STAGE_KEYS}
+    stats["total_gold"] = 0
+    stats["total_valor"] = 0
+    return stats
+
+
+def classify_events(events):
+    """
+    Этап каждого события из отсортированного по времени списка (ts, val, etype).
+    Возвращает список той же длины: ключ из STAGE_KEYS или None.
+    Соседи для проверки танца берутся из общей последовательности вкладов (1 и 2).
+    """
+    stages = []
+    last = len(events) - 1
+    for i, (ts, val, etype) in enumerate(events):
+        if etype != 1:
+            stages.append(None)
+            continue
+
+        if val == 4:
+            is_dance = False
+            # Проверка назад (< 20 мин)
+            if i > 0:
+                prev_ts, prev_val, prev_type = events[i - 1]
+                if prev_type == 1 and prev_val == 2 and (ts - prev_ts) < DANCE_WINDOW:
+                    is_dance = True
+
+            # Проверка вперед (< 20 мин)
+            if not is_dance and i < last:
+                next_ts, next_val, next_type = events[i + 1]
+                if next_type == 1 and next_val == 8 and (next_ts - ts) < DANCE_WINDOW:
+                    is_dance = True
+
+            stages.append("dances" if is_dance else "s1")
+        else:
+            stages.append(STAGE_BY_VALOR.get(val))
+    return stages
+
+
+def analyze_stats(events):
+    """
+    Анализирует список событий игрока (ts, val, etype).
+    Возвращает словарь со всеми счетчиками (золото, доблесть, этапы).
+    """
+    stats = empty_stats()
+    events.sort(key=lambda x: x[0])
+
+    for (ts, val, etype), stage in zip(events, classify_events(events)):
+        if etype == 2:
+            stats["total_gold"] += val
+        elif etype == 1:
+            stats["total_valor"] += val
+            if stage:
+                stats[stage] += 1
+
+    return stats
+
+
+def classify_batch(role_id, ts, value, etype):
+    """
+    Векторный classify_events сразу для всех игроков: колонки (role_id, ts, value, type)
+    в любом порядке. Возвращает массив индексов STAGE_KEYS в порядке входа (-1 - без этапа).
+    Внутри игрока события упорядочены по ts, равные ts - в порядке входа (как sort в analyze_stats).
+    """
+    role_id = np.asarray(role_id, dtype=np.int64)
+    ts = np.asarray(ts, dtype=np.int64)
+    value = np.asarray(value, dtype=np.int64)
+    etype = np.asarray(etype, dtype=np.int64)
+    count = len(role_id)
+
+    order = np.lexsort((np.arange(count), ts, role_id))
+    r, t, v, e = role_id[order], ts[order], value[order], etype[order]
+
+    # Соседи в общей последовательности вкладов одного игрока
+    same = r[1:] == r[:-1]
+    close = (t[1:] - t[:-1]) < DANCE_WINDOW
+    dance = np.zeros(count, dtype=bool)
+    dance[1:] |= same & close & (e[:-1] == 1) & (v[:-1] == 2)   # 2 перед вкладом
+    dance[:-1] |= same & close & (e[1:] == 1) & (v[1:] == 8)    # 8 после вклада
+
+    codes = np.full(count, -1, dtype=np.int64)
+    valor = e == 1
+    for val, key in STAGE_BY_VALOR.items():
+        codes[valor & (v == val)] = STAGE_KEYS.index(key)
+    fours = valor & (v == 4)
+    codes[fours & dance] = STAGE_KEYS.index("dances")
+
+    result = np.empty(count, dtype=np.int64)
+    result[order] = codes
+    return result
+
+
+def analyze_stats_batch(role_id, ts, value, etype):
+    """
+    analyze_stats для всех игроков за один проход (numpy: lexsort, сдвиги, bincount).
+    Принимает колонки событий (типы 1 и 2) за период, возвращает {role_id: stats}
+    с теми же ключами и значениями, что analyze_stats по событиям каждого игрока.
+    """
+    role_id = np.asarray(role_id, dtype=np.int64)
+    value = np.asarray(value, dtype=np.int64)
+    etype = np.asarray(etype, dtype=np.int64)
+    if not len(role_id):
+        return {}
+
+    codes = classify_batch(role_id, ts, value, etype)
+    roles, idx = np.unique(role_id, return_inverse=True)
+    players = len(roles)
+
+    gold = np.bincount(idx[etype == 2], weights=value[etype == 2], minlength=players)
+    valor = np.bincount(idx[etype == 1], weights=value[etype == 1], minlength=players)
+    staged = codes >= 0
+    stages = np.bincount(
+        idx[staged] * len(STAGE_KEYS) + codes[staged], minlength=players * len(STAGE_KEYS)
+    ).reshape(players, len(STAGE_KEYS))
+
+    result = {}
+    for i, rid in enumerate(roles.tolist()):
+        stats = dict(zip(STAGE_KEYS, stages[i].tolist()))
+        stats["total_gold"] = int(gold[i])
+        stats["total_valor"] = int(valor[i])
+        result[rid] = stats
+    return result
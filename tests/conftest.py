@@ -0,0 +1,25 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# Модули проекта лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import Database
+from migrations import migrate
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Пустая БД с актуальной схемой во временном каталоге."""
+    database = Database(str(tmp_path / "test.db"), readers=1)
+
+    async def start():
+        await database.open()
+        await migrate(database)
+
+    asyncio.run(start())
+    yield database
+    asyncio.run(database.close())
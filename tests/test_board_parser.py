@@ -0,0 +1,50 @@
+import struct
+
+from board_parser import HEADER_FORMAT, RECORD_FORMAT, iter_board_batches, parse_board_columns
+
+BASE_TS = 1_700_000_000
+
+
+def board(ids, from_id=None, to_id=None):
+    """Файл FactionBoard с вкладами золота для записей с id из ids."""
+    from_id = ids[0] if from_id is None else from_id
+    to_id = ids[-1] if to_id is None else to_id
+    data = struct.pack(HEADER_FORMAT, from_id, to_id)
+    for rid in ids:
+        data += struct.pack(RECORD_FORMAT, 2, rid, BASE_TS + rid, 1000 + rid % 7, rid, 0, 0)
+    return data
+
+
+def read_ids(data, covered=None):
+    return [rec.id for batch in iter_board_batches(data, batch_size=4, covered=covered) for rec in batch]
+
+
+def test_all_records_in_file_order():
+    data = board(list(range(100, 110)))
+    assert read_ids(data) == list(range(100, 110))
+    assert parse_board_columns(data)["id"].tolist() == list(range(109, 99, -1))
+
+
+def test_covered_prefix_is_skipped():
+    assert read_ids(board(list(range(100, 110))), covered=[(100, 105)]) == [106, 107, 108, 109]
+
+
+def test_older_archive_after_newer_one():
+    assert read_ids(board([50, 51]), covered=[(100, 103)]) == [50, 51]
+
+
+def test_records_past_header_to_id():
+    # Заголовок не изменился (to_id = 109), а в конец дописаны 110 и 111
+    data = board(list(range(100, 112)), to_id=109)
+    assert read_ids(data, covered=[(100, 109)]) == [110, 111]
+
+
+def test_gap_in_file_falls_back_to_id_filter():
+    # Записи не подряд: по индексу last_id лежит другая запись - фильтр по id
+    ids = [100, 101, 150, 151, 152]
+    assert read_ids(board(ids), covered=[(100, 101), (151, 151)]) == [150, 152]
+
+
+def test_record_day_matches_date():
+    rec = next(iter_board_batches(board([100])))[0]
+    assert rec.day == int(rec.date[:10].replace("-", ""))
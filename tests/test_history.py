@@ -0,0 +1,54 @@
+import asyncio
+import struct
+
+import pytest
+from fastapi.testclient import TestClient
+
+import web_app
+from board_parser import HEADER_FORMAT, RECORD_FORMAT
+from ingest import ingest_file
+
+BASE_TS = 1_700_000_000  # 2023-11-14
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    # Вклад золота и выход из гильдии - описания на кириллице
+    records = [(2, 100, 0, 501, 30), (2, 101, 60, 502, 40), (8, 102, 120, 503, 0)]
+    data = struct.pack(HEADER_FORMAT, 100, 102)
+    for rtype, rid, offset, role_id, p0 in records:
+        data += struct.pack(RECORD_FORMAT, rtype, rid, BASE_TS + offset, role_id, p0, 0, 0)
+
+    async def upload():
+        async with database.write() as conn:
+            await ingest_file(conn, data, "FactionBoard1")
+
+    asyncio.run(upload())
+    monkeypatch.setattr(web_app, "db", database)
+    monkeypatch.setattr(web_app, "directory", web_app.PlayerDirectory())
+    monkeypatch.setattr(web_app, "page_cache", web_app.ResponseCache())
+    return TestClient(web_app.app)
+
+
+def search(client, text):
+    response = client.get("/api/history", params={"start": "2023-11-01", "end": "2023-11-30", "search": text})
+    return [row["id"] for row in response.json()["rows"]]
+
+
+@pytest.mark.parametrize("text", ["Вклад", "вклад", "ВКЛАД", "вКлАд (зОлОтО)"])
+def test_search_ignores_cyrillic_case(client, text):
+    assert len(search(client, text)) == 2
+
+
+@pytest.mark.parametrize("text", ["Покинул", "покинул", "ПОКИНУЛ"])
+def test_search_leave_any_case(client, text):
+    assert len(search(client, text)) == 1
+
+
+def test_search_by_date(client):
+    day = web_app.datetime.fromtimestamp(BASE_TS).strftime("%Y-%m-%d")
+    assert len(search(client, day)) == 3
+
+
+def test_search_escapes_like_wildcards(client):
+    assert search(client, "%") == []
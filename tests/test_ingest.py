@@ -0,0 +1,47 @@
+import asyncio
+import struct
+
+from board_parser import HEADER_FORMAT, RECORD_FORMAT
+from ingest import ingest_file
+
+BASE_TS = 1_700_000_000
+ROLE = 777
+
+
+def board(records):
+    """Файл FactionBoard из записей (id, type, смещение ts, p0)."""
+    data = struct.pack(HEADER_FORMAT, records[0][0], records[-1][0])
+    for rid, rtype, offset, p0 in records:
+        data += struct.pack(RECORD_FORMAT, rtype, rid, BASE_TS + offset, ROLE, p0, 0, 0)
+    return data
+
+
+def upload(database, data, filename="FactionBoard1"):
+    async def run():
+        async with database.write() as conn:
+            return await ingest_file(conn, data, filename)
+    return asyncio.run(run())
+
+
+def in_clan(database):
+    async def run():
+        async with database.read() as conn:
+            async with conn.execute("SELECT in_clan FROM players WHERE role_id = ?", (ROLE,)) as cursor:
+                return (await cursor.fetchone())[0]
+    return asyncio.run(run())
+
+
+def test_old_file_does_not_restore_membership(database):
+    # Новый файл: вклад, затем игрок покинул гильдию
+    upload(database, board([(200, 2, 0, 10), (201, 8, 50, 0)]))
+    assert in_clan(database) == 0
+    # Старый архив с вкладом между ними приходит позже
+    result = upload(database, board([(100, 2, 5, 20)]))
+    assert result["new_events"] == 1
+    assert in_clan(database) == 0
+
+
+def test_newer_file_updates_membership(database):
+    upload(database, board([(200, 8, 50, 0)]))
+    upload(database, board([(300, 2, 90, 10)]))
+    assert in_clan(database) == 1
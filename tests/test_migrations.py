@@ -0,0 +1,34 @@
+import asyncio
+
+import migrations
+
+
+def test_event_day_backfill_walks_ids(database, monkeypatch):
+    monkeypatch.setattr(migrations, "BACKFILL_CHUNK", 3)
+
+    async def run():
+        async with database.write() as conn:
+            await conn.executemany(
+                "INSERT INTO events (role_id, timestamp, event_date, event_type, value, raw_desc) VALUES (?, ?, ?, 2, 1, '')",
+                [(i, 1_700_000_000 + i, f"2025-01-{i + 1:02d} 12:00:00") for i in range(10)]
+                + [(99, 1_700_000_099, "Error Date")]
+            )
+            await conn.commit()
+
+            positions = []
+            position = None
+            while True:
+                _, position = await migrations._backfill_event_day(conn, position)
+                if position is None:
+                    break
+                positions.append(position)
+            await conn.commit()
+
+            async with conn.execute("SELECT role_id, day FROM events ORDER BY id") as cursor:
+                return positions, await cursor.fetchall()
+
+    positions, rows = asyncio.run(run())
+    # 11 строк порциями по 3: позиция растет, каждая порция начинается после прошлой
+    assert positions == sorted(positions) and len(positions) == 3
+    assert rows[:10] == [(i, 20250101 + i) for i in range(10)]
+    assert rows[10] == (99, None)
@@ -0,0 +1,77 @@
+import random
+
+import pytest
+
+from stats import analyze_stats, analyze_stats_batch, DANCE_WINDOW
+
+VALOR_VALUES = (2, 4, 6, 7, 8, 10, 14, 24, 40, 70, 3)
+
+
+def by_player(events):
+    """analyze_stats по каждому игроку; events - (role_id, ts, value, type) в порядке входа."""
+    grouped = {}
+    for rid, ts, val, etype in events:
+        grouped.setdefault(rid, []).append((ts, val, etype))
+    return {rid: analyze_stats(evs) for rid, evs in grouped.items()}
+
+
+def batch(events):
+    if not events:
+        return analyze_stats_batch([], [], [], [])
+    return analyze_stats_batch(*zip(*events))
+
+
+def random_events(rng, players, count, span):
+    events = []
+    for _ in range(count):
+        rid = rng.randrange(players)
+        # Узкий диапазон времени - много равных ts и соседей около границы окна
+        ts = 1_700_000_000 + rng.randrange(span)
+        if rng.random() < 0.3:
+            events.append((rid, ts, rng.randrange(1, 500), 2))
+        else:
+            events.append((rid, ts, rng.choice(VALOR_VALUES), 1))
+    return events
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_batch_matches_per_player(seed):
+    rng = random.Random(seed)
+    events = random_events(rng, players=rng.randint(1, 8), count=rng.randint(0, 120),
+                           span=rng.choice((5, 1300, 3 * DANCE_WINDOW, 86400)))
+    assert batch(events) == by_player(events)
+
+
+@pytest.mark.parametrize("gap, dance", [(DANCE_WINDOW - 1, True), (DANCE_WINDOW, False)])
+def test_dance_window_boundary(gap, dance):
+    t = 1_700_000_000
+    before = [(1, t, 2, 1), (1, t + gap, 4, 1)]    # 2 перед вкладом 4
+    after = [(2, t, 4, 1), (2, t + gap, 8, 1)]     # 8 после вклада 4
+    result = batch(before + after)
+    assert result == by_player(before + after)
+    for rid in (1, 2):
+        # Сами вклады 2 и 8 всегда считаются танцами, вклад 4 - только в окне
+        assert result[rid]["dances"] == (2 if dance else 1)
+        assert result[rid]["s1"] == (0 if dance else 1)
+
+
+def test_tied_timestamps_keep_input_order():
+    t = 1_700_000_000
+    events = [(1, t, 4, 1), (1, t, 2, 1), (1, t, 4, 1), (1, t, 8, 1), (1, t + 5, 4, 1)]
+    assert batch(events) == by_player(events)
+    # Равные ts - в порядке входа: первый вклад 4 идет до двойки и остается этапом 1
+    assert batch(events)[1]["s1"] == 2 and batch(events)[1]["dances"] == 3
+
+
+def test_gold_between_breaks_dance():
+    t = 1_700_000_000
+    events = [(1, t, 2, 1), (1, t + 10, 100, 2), (1, t + 20, 4, 1), (2, t, 4, 1), (2, t, 50, 2), (2, t + 1, 8, 1)]
+    result = batch(events)
+    assert result == by_player(events)
+    # Соседом вклада 4 оказывается золото - это не танец
+    assert result[1]["s1"] == 1 and result[1]["dances"] == 1 and result[1]["total_gold"] == 100
+    assert result[2]["s1"] == 1 and result[2]["dances"] == 1
+
+
+def test_empty():
+    assert batch([]) == {}
@@ -1,9 +1,17 @@
 import time
 import os
-import glob
+import hashlib
+import json
+import gzip
 import sys
 import logging
+import random
+import shutil
 import threading
+import select
+import struct
+import ctypes
+import ctypes.util
 import tkinter as tk
 from tkinter import scrolledtext
 from tkinter import messagebox, filedialog
@@ -19,10 +27,34 @@ load_dotenv()
 TARGET_SUFFIX = os.path.join("element", "userdata", "FactionData", "FactionHistoryData")
 CONFIG_FILE = "watcher.ini"
 SERVER_URL = os.getenv("SITE_URL", "https://requiem.share.zrok.io")
-CHECK_INTERVAL = 60
+CHECK_INTERVAL = 60     # Максимальный сон цикла без событий (сек)
+POLL_INTERVAL = 5       # Опрос папки, если уведомления ФС недоступны (сек)
+DEBOUNCE_SECONDS = int(os.getenv("WATCHER_DEBOUNCE", "30"))  # Файл "затих" - можно отправлять
+FILE_PREFIX = "FactionBoard"
+JOB_POLL_INTERVAL = 2   # Как часто спрашивать сервер о статусе загрузки (сек)
+JOB_TIMEOUT = 300       # Сколько ждать обработки файла сервером (сек)
+SPOOL_DIR = "spool"     # Файлы, которые не удалось отправить, ждут здесь
+TAIL_MODE = os.getenv("WATCHER_TAIL_MODE", "0") == "1"  # Отправлять дописанные записи, не дожидаясь конца сессии (WATCHER_TAIL_MODE=1)
+TAIL_DEBOUNCE = 3       # Пауза записи, после которой отправляем хвост (сек)
+STATE_FILE = "watcher_state.json"
+HEADER_SIZE = 8         # Формат файла совпадает с board_parser: заголовок 8 байт,
+RECORD_SIZE = 28        # записи по 28 байт
+HTTP_TIMEOUT = (5, 60)  # (connect, read) сек
+BACKOFF_BASE = 5        # Первая пауза после неудачи (сек), дальше x2
+BACKOFF_MAX = 900       # Потолок паузы (сек)
 APP_NAME = "PWLogWatcher"
 LOG_FILE = "watcher.log"
 
+HEADERS = {
+    "ngrok-skip-browser-warning": "true",
+    "skip_zrok_interstitial": "true",
+    "User-Agent": "PwLogWatcher/1.0"
+}
+
+# Одна keep-alive сессия на все запросы: без нового TCP/TLS рукопожатия каждый раз
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
 # --- LOGGING ---
 logging.basicConfig(
     level=logging.INFO,
@@ -165,12 +197,160 @@ def create_shortcut_vbs(target, shortcut_path, arguments, working_dir):
             try: os.remove(vbs_path)
             except: pass
 
+def upload_name(filepath):
+    """Имя файла для сервера: у файлов из очереди отрезаем префикс порядка "<ns>_"."""
+    name = os.path.basename(filepath)
+    if os.path.dirname(os.path.abspath(filepath)) == os.path.abspath(SPOOL_DIR):
+        name = name.split("_", 1)[-1]
+    return name
+
+def backoff_delay(failures):
+    """Экспоненциальная пауза с джиттером, чтобы все утилиты не ломились разом."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** max(0, failures - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+class TailState:
+    """Сколько байт каждого файла уже отправлено (хранится между запусками)."""
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.files = json.load(f)
+            except Exception as e:
+                logging.error(f"[ERR] Не прочитан {path}: {e}")
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def set(self, name, header, offset):
+        self.files[name] = {"header": header.hex(), "offset": offset}
+        self.save()
+
+    def drop(self, name):
+        if self.files.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f)
+        os.replace(tmp, self.path)
+
+def file_sha256(filepath):
+    with open(filepath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# --- FILE MONITORS ---
+class PollingMonitor:
+    """Опрос папки с кэшем (mtime, size): сообщает только об изменившихся файлах."""
+
+    def __init__(self, path, stop_event):
+        self.path = path
+        self.stop_event = stop_event
+        self.cache = {}
+
+    def scan(self):
+        changed = set()
+        seen = {}
+        try:
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    if not entry.name.startswith(FILE_PREFIX) or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    seen[entry.name] = (st.st_mtime, st.st_size)
+                    if self.cache.get(entry.name) != seen[entry.name]:
+                        changed.add(entry.name)
+        except OSError as e:
+            logging.error(f"[ERR] Чтение папки: {e}")
+            return changed
+        self.cache = seen
+        return changed
+
+    def wait(self, timeout):
+        self.stop_event.wait(min(timeout, POLL_INTERVAL))
+        return self.scan()
+
+    def close(self):
+        pass
+
+
+class InotifyMonitor:
+    """Уведомления inotify (Linux) через ctypes, без сторонних библиотек."""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path, stop_event):
+        self.path = path
+        self.stop_event = stop_event
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch")
+
+    def scan(self):
+        # Полный список нужен только при старте, дальше хватает событий
+        return {name for name in os.listdir(self.path) if name.startswith(FILE_PREFIX)}
+
+    def wait(self, timeout):
+        # select с коротким шагом, чтобы вовремя заметить stop_event
+        ready, _, _ = select.select([self.fd], [], [], min(timeout, 1))
+        if not ready:
+            return set()
+
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        pos = 0
+        while pos + self.EVENT_HEADER.size <= len(data):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b"\0").decode(errors="replace")
+            pos += length
+            if name.startswith(FILE_PREFIX):
+                changed.add(name)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_monitor(path, stop_event):
+    """inotify на Linux, иначе опрос папки с кэшем."""
+    if sys.platform.startswith("linux"):
+        try:
+            monitor = InotifyMonitor(path, stop_event)
+            logging.info("[WATCH] Режим: inotify")
+            return monitor
+        except (OSError, AttributeError) as e:
+            logging.warning(f"[WATCH] inotify недоступен ({e}), переключаемся на опрос")
+    logging.info(f"[WATCH] Режим: опрос каждые {POLL_INTERVAL} сек")
+    return PollingMonitor(path, stop_event)
+
 # --- THREADED WATCHER ---
 class WatcherThread(threading.Thread):
     def __init__(self):
         super().__init__()
         self.stop_event = threading.Event()
         self.game_log_dir = None
+        self.spool_failures = 0
+        self.next_spool_try = 0
+        self.tail_state = TailState()
 
     def run(self):
         logging.info("[THREAD] Запуск потока слежения...")
@@ -183,51 +363,264 @@ class WatcherThread(threading.Thread):
         logging.info(f"[THREAD] Слежение за: {self.game_log_dir}")
         set_startup(True) # Default enable on run if successful
 
-        while not self.stop_event.is_set():
+        monitor = create_monitor(self.game_log_dir, self.stop_event)
+        # Файл -> время последнего изменения. Уже лежащие файлы считаем измененными по mtime.
+        dirty = {}
+        for name in monitor.scan():
+            filepath = os.path.join(self.game_log_dir, name)
             try:
-                self.check_files()
-            except Exception as e:
-                logging.error(f"[THREAD] Ошибка цикла: {e}")
-            
-            # Wait with check for stop interval
-            for _ in range(CHECK_INTERVAL):
-                if self.stop_event.is_set(): break
-                time.sleep(1)
-
-    def check_files(self):
-        pattern = os.path.join(self.game_log_dir, "FactionBoard*")
-        files = glob.glob(pattern)
-        for filepath in files:
-            try:
-                mtime = os.path.getmtime(filepath)
-                if time.time() - mtime < 300: # 5 min age
-                    continue
+                dirty[filepath] = os.path.getmtime(filepath)
             except OSError:
-                continue
+                pass
+
+        # Файл -> время изменения, на момент которого хвост уже отправлен
+        tail_sent = {}
+
+        try:
+            while not self.stop_event.is_set():
+                if self.spooled_files() and time.time() >= self.next_spool_try:
+                    self.drain_spool()
+
+                now = time.time()
+                deadlines = [now + CHECK_INTERVAL]
+                deadlines += [t + DEBOUNCE_SECONDS for t in dirty.values()]
+                if TAIL_MODE:
+                    deadlines += [t + TAIL_DEBOUNCE for p, t in dirty.items() if tail_sent.get(p) != t]
+                if self.spooled_files():
+                    deadlines.append(self.next_spool_try)
+                timeout = max(0.1, min(deadlines) - now)
+
+                for name in monitor.wait(timeout):
+                    dirty[os.path.join(self.game_log_dir, name)] = time.time()
+
+                now = time.time()
+                if TAIL_MODE:
+                    for filepath, t in list(dirty.items()):
+                        if now - t >= TAIL_DEBOUNCE and tail_sent.get(filepath) != t:
+                            # При неудаче пробуем снова на следующем изменении или при финальной отправке
+                            self.send_delta(filepath)
+                            tail_sent[filepath] = t
+
+                ready = [p for p, t in dirty.items() if now - t >= DEBOUNCE_SECONDS]
+                if not ready:
+                    continue
 
-            if self.upload_file(filepath):
                 try:
-                    os.remove(filepath)
-                    logging.info(f"[DEL] Удален: {filepath}")
+                    uploaded = self.check_files(ready)
                 except Exception as e:
-                    logging.error(f"[ERR] Не удален {filepath}: {e}")
+                    logging.error(f"[THREAD] Ошибка цикла: {e}")
+                    uploaded = []
+
+                for filepath in ready:
+                    dirty.pop(filepath, None)
+                    tail_sent.pop(filepath, None)
+                    if filepath not in uploaded and os.path.exists(filepath):
+                        self.spool_file(filepath)
+                if len(uploaded) < len(ready):
+                    self.schedule_spool_retry(success=False)
+        finally:
+            monitor.close()
+
+    def spooled_files(self):
+        """Файлы в очереди на отправку, от старых к новым."""
+        if not os.path.isdir(SPOOL_DIR):
+            return []
+        names = sorted(n for n in os.listdir(SPOOL_DIR) if FILE_PREFIX in n)
+        return [os.path.join(SPOOL_DIR, n) for n in names]
+
+    def spool_file(self, filepath):
+        """Переносит неотправленный файл в очередь (префикс - время, чтобы сохранить порядок)."""
+        try:
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            dest = os.path.join(SPOOL_DIR, f"{time.time_ns()}_{os.path.basename(filepath)}")
+            shutil.move(filepath, dest)
+            logging.info(f"[SPOOL] {os.path.basename(filepath)} -> очередь")
+        except Exception as e:
+            logging.error(f"[ERR] Не удалось положить в очередь {filepath}: {e}")
+
+    def schedule_spool_retry(self, success):
+        if success:
+            self.spool_failures = 0
+            self.next_spool_try = 0
+        else:
+            self.spool_failures += 1
+            delay = backoff_delay(self.spool_failures)
+            self.next_spool_try = time.time() + delay
+            logging.info(f"[SPOOL] Следующая попытка через {delay:.0f} сек")
+
+    def drain_spool(self):
+        """Отправляет очередь по порядку, пока сервер отвечает."""
+        files = self.spooled_files()
+        logging.info(f"[SPOOL] В очереди {len(files)} файлов")
+        try:
+            uploaded = self.check_files(files)
+        except Exception as e:
+            logging.error(f"[SPOOL] Ошибка: {e}")
+            uploaded = []
+        self.schedule_spool_retry(success=len(uploaded) == len(files))
+
+    def check_files(self, ready):
+        """Отправляет затихшие файлы и удаляет успешно загруженные. Возвращает их список."""
+        uploaded = []
+        if TAIL_MODE:
+            # Файлы из папки игры, у которых уже отправлен весь хвост, повторно не шлем
+            for filepath in ready:
+                if os.path.dirname(filepath) == self.game_log_dir and self.send_delta(filepath):
+                    uploaded.append(filepath)
+            ready = [p for p in ready if p not in uploaded]
+
+        # Несколько файлов - одним сжатым запросом
+        if len(ready) > 1:
+            uploaded += self.upload_batch(ready)
+        else:
+            uploaded += [filepath for filepath in ready if self.upload_file(filepath)]
+
+        for filepath in uploaded:
+            try:
+                os.remove(filepath)
+                logging.info(f"[DEL] Удален: {filepath}")
+            except Exception as e:
+                # Состояние хвоста остается: иначе файл уйдет заново целиком
+                logging.error(f"[ERR] Не удален {filepath}: {e}")
+                continue
+            if os.path.dirname(filepath) == self.game_log_dir:
+                self.tail_state.drop(os.path.basename(filepath))
+        return uploaded
+
+    def send_delta(self, filepath):
+        """
+        Отправляет только дописанные с прошлого раза записи: заголовок файла + новые
+        28-байтные записи. Возвращает True, если на сервере уже всё содержимое файла.
+        """
+        name = os.path.basename(filepath)
+        try:
+            with open(filepath, 'rb') as f:
+                header = f.read(HEADER_SIZE)
+                size = os.fstat(f.fileno()).st_size
+                if len(header) < HEADER_SIZE:
+                    return False
+                end = HEADER_SIZE + (size - HEADER_SIZE) // RECORD_SIZE * RECORD_SIZE
+
+                state = self.tail_state.get(name)
+                offset = HEADER_SIZE
+                # Файл пересоздан (другой from_id) или усечен - начинаем сначала.
+                # to_id в заголовке растет при каждой дописке - на продолжение не влияет
+                from_id = header[:4].hex()
+                if state and state["header"][:len(from_id)] == from_id and state["offset"] <= end:
+                    offset = state["offset"]
+                if offset >= end:
+                    return True
+
+                f.seek(offset)
+                payload = header + f.read(end - offset)
+        except OSError as e:
+            logging.error(f"[ERR] Чтение {name}: {e}")
+            return False
+
+        url = f"{SERVER_URL}/api/upload/delta"
+        logging.info(f"[TAIL] {name}: {(end - offset) // RECORD_SIZE} новых записей")
+        try:
+            files = {'file': (name, gzip.compress(payload), 'application/gzip')}
+            response = SESSION.post(url, files=files, data={"offset": offset, "encoding": "gzip"}, timeout=HTTP_TIMEOUT)
+            if response.status_code != 200:
+                logging.error(f"[ERR] HTTP {response.status_code}")
+                return False
+            res = response.json()
+            if res.get("status") != "ok":
+                logging.warn(f"[WARN] Сервер: {res}")
+                return False
+            if res.get("job_id") and not self.wait_for_job(res["job_id"]):
+                return False
+        except Exception as e:
+            logging.error(f"[ERR] Соединение: {e}")
+            return False
+
+        self.tail_state.set(name, header, end)
+        return True
+
+    def known_hashes(self, digests):
+        """Спрашивает сервер, какие из sha256 уже загружены (например, другими соклановцами)."""
+        try:
+            response = SESSION.get(f"{SERVER_URL}/api/upload/check", params={"sha256": digests}, timeout=HTTP_TIMEOUT)
+            if response.status_code == 200:
+                res = response.json()
+                if "known_hashes" in res:
+                    return set(res["known_hashes"])
+                return set(digests) if res.get("known") else set()
+        except Exception as e:
+            logging.error(f"[ERR] Проверка хэша: {e}")
+        return set()
+
+    def is_known(self, filepath):
+        digest = file_sha256(filepath)
+        return digest in self.known_hashes([digest])
+
+    def upload_batch(self, filepaths):
+        """Загружает несколько файлов одним gzip-запросом. Возвращает список успешно обработанных."""
+        digests = {filepath: file_sha256(filepath) for filepath in filepaths}
+        known = self.known_hashes(list(digests.values()))
+
+        done = []
+        pending = []
+        for filepath in filepaths:
+            if digests[filepath] in known:
+                logging.info(f"[SKIP] {upload_name(filepath)} уже загружен")
+                done.append(filepath)
+            else:
+                pending.append(filepath)
+        if not pending:
+            return done
+
+        url = f"{SERVER_URL}/api/upload/batch"
+        logging.info(f"[UPLOAD] Пакет из {len(pending)} файлов")
+        try:
+            files = []
+            for filepath in pending:
+                with open(filepath, 'rb') as f:
+                    files.append(('files', (upload_name(filepath), gzip.compress(f.read()), 'application/gzip')))
+            response = SESSION.post(url, files=files, data={"encoding": "gzip"}, timeout=HTTP_TIMEOUT)
+
+            if response.status_code != 200:
+                logging.error(f"[ERR] HTTP {response.status_code}")
+                return done
+
+            res = response.json()
+            if res.get("status") != "ok":
+                logging.warn(f"[WARN] Сервер: {res}")
+                return done
+
+            for filepath, item in zip(pending, res.get("results", [])):
+                name = upload_name(filepath)
+                if item.get("status") != "ok":
+                    logging.warn(f"[WARN] {name}: {item.get('message')}")
+                elif item.get("job_id"):
+                    if self.wait_for_job(item["job_id"]):
+                        done.append(filepath)
+                else:
+                    logging.info(f"[OK] {name}: {item.get('new_events')} новых строк")
+                    done.append(filepath)
+        except Exception as e:
+            logging.error(f"[ERR] Соединение: {e}")
+        return done
 
     def upload_file(self, filepath):
+        if self.is_known(filepath):
+            logging.info(f"[SKIP] {upload_name(filepath)} уже загружен")
+            return True
+
         url = f"{SERVER_URL}/api/upload"
-        logging.info(f"[UPLOAD] {os.path.basename(filepath)}")
+        logging.info(f"[UPLOAD] {upload_name(filepath)}")
         try:
             with open(filepath, 'rb') as f:
-                files = {'file': (os.path.basename(filepath), f)}
-                headers = {
-                    "ngrok-skip-browser-warning": "true",
-                    "skip_zrok_interstitial": "true",
-                    "User-Agent": "PwLogWatcher/1.0"
-                }
-                response = requests.post(url, files=files, headers=headers)
+                files = {'file': (upload_name(filepath), f)}
+                response = SESSION.post(url, files=files, timeout=HTTP_TIMEOUT)
                 
             if response.status_code == 200:
                 res = response.json()
                 if res.get("status") == "ok":
+                    # Сервер принял файл в очередь - ждем окончания обработки
+                    if res.get("job_id"):
+                        return self.wait_for_job(res["job_id"])
                     logging.info(f"[OK] {res.get('new_events')} новых строк")
                     return True
                 else:
@@ -238,6 +631,31 @@ class WatcherThread(threading.Thread):
             logging.error(f"[ERR] Соединение: {e}")
         return False
 
+    def wait_for_job(self, job_id):
+        """Опрашивает /api/upload/{job_id}, пока сервер не запишет файл в базу."""
+        url = f"{SERVER_URL}/api/upload/{job_id}"
+        deadline = time.time() + JOB_TIMEOUT
+        while time.time() < deadline and not self.stop_event.is_set():
+            try:
+                res = SESSION.get(url, timeout=HTTP_TIMEOUT).json()
+            except Exception as e:
+                logging.error(f"[ERR] Статус загрузки: {e}")
+                return False
+
+            if res.get("status") != "ok":
+                logging.warn(f"[WARN] Сервер: {res}")
+                return False
+            if res.get("state") == "done":
+                logging.info(f"[OK] {res.get('new_events')} новых строк")
+                return True
+            if res.get("state") == "error":
+                logging.warn(f"[WARN] Сервер: {res.get('message')}")
+                return False
+            self.stop_event.wait(JOB_POLL_INTERVAL)
+
+        logging.warn(f"[WARN] Не дождались обработки задачи {job_id}")
+        return False
+
     def stop(self):
         self.stop_event.set()
 
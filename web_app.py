@@ -1,96 +1,145 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-import aiosqlite
 from datetime import datetime, timedelta, timezone
-import shutil
+from email.utils import formatdate, parsedate_to_datetime
+import asyncio
+import gzip
+import json
+import logging
 import os
 from typing import List
-from fastapi import UploadFile, File, Query
+from fastapi import UploadFile, File, Form, Query
 from fastapi.staticfiles import StaticFiles
+from fastapi.middleware.gzip import GZipMiddleware
+try:
+    import orjson  # Быстрый кодировщик JSON; без него - стандартный json
+except ImportError:
+    orjson = None
 # Подгружаем парсер. Если он в той же папке - отлично.
 try:
-    from board_parser import parse_board_file
+    from ingest import IngestQueue, file_digest
+    from board_parser import HEADER_SIZE, RECORD_SIZE
 except ImportError:
     pass # Обработаем если надо, но предполагаем что он есть
 from consts import CLASSES
+from stats import STAGE_KEYS, analyze_stats_batch
+from db import db, ledger_has, day_number, get_generation, bump_generation, search_pattern
+from cache import ResponseCache, make_etag
+from export import EXPORT_FORMATS, export_rows, export_stream
+from live import LiveBroker, sse
+from snapshots import SnapshotStore, SnapshotFiles, SNAPSHOT_DIR, SNAPSHOT_URL
+from migrations import migrate, start_backfills, backfill_done
+from leaderboard import LeaderboardIndex
+from directory import PlayerDirectory, TARGET_TYPES
 
 
 app = FastAPI()
+# Сжатие ответов (JSON, HTML) для туннеля; SSE (text/event-stream) middleware не трогает
+app.add_middleware(GZipMiddleware, minimum_size=1000)
 app.mount("/static", StaticFiles(directory="static"), name="static")
+# Снимки частых периодов: отдаются как статика, без запросов к БД
+os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+app.mount(SNAPSHOT_URL, SnapshotFiles(directory=SNAPSHOT_DIR, html=True), name="snapshots")
 templates = Jinja2Templates(directory="templates")
-DB_NAME = "clan_archive.db"
+
+
+leaderboard = LeaderboardIndex()
+directory = PlayerDirectory()
+page_cache = ResponseCache()
+live = LiveBroker()
+snapshots = SnapshotStore()
+ingest_queue = IngestQueue()
+backfill_task = None
+live_task = None
+snapshot_task = None
+rollups_ready = False  # daily_stats заполнена (фоновая миграция завершена)
+event_days_ready = False  # events.day заполнен для старых строк (фоновая миграция event_day)
+
+
+async def reload_leaderboard():
+    async with db.read() as conn:
+        await leaderboard.load(conn)
+
+async def load_directory():
+    async with db.read() as conn:
+        await directory.load(conn)
+
+
+@app.on_event("startup")
+async def on_startup():
+    global backfill_task, live_task, snapshot_task
+    await db.open()
+    await migrate(db)
+    await reload_leaderboard()
+    await load_directory()
+    # После фоновых миграций daily_stats мог заполниться - перечитываем индекс
+    backfill_task = start_backfills(db, on_done=reload_leaderboard)
+    # После каждой записанной загрузки: индекс лидерборда + живые обновления
+    ingest_queue.on_commit = after_ingest
+    await ingest_queue.start()
+    live_task = asyncio.create_task(live_loop())
+    snapshots.notify()  # Первая сборка снимков - сразу
+    snapshot_task = asyncio.create_task(snapshot_loop())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await ingest_queue.stop()
+    for task in (backfill_task, live_task, snapshot_task):
+        if task:
+            task.cancel()
+    await db.close()
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-async def get_last_update_time():
-    """Получает дату самой свежей записи в БД и конвертирует в МСК (UTC+3)."""
-    async with aiosqlite.connect(DB_NAME) as conn:
-        cursor = await conn.execute("SELECT MAX(timestamp) FROM events")
-        row = await cursor.fetchone()
-        ts = row[0]
-        if ts:
-            # 1. Получаем дату как UTC (независимо от сервера)
-            dt_utc = datetime.fromtimestamp(ts, timezone.utc)
-            # 2. Добавляем ровно 3 часа (МСК)
-            dt_msk = dt_utc + timedelta(hours=3)
-            return dt_msk.strftime('%d.%m.%Y %H:%M') + " (МСК)"
+def get_last_update_time(updated_at):
+    """Время последнего изменения данных (meta.updated_at) в МСК (UTC+3)."""
+    if updated_at:
+        # 1. Получаем дату как UTC (независимо от сервера)
+        dt_utc = datetime.fromtimestamp(updated_at, timezone.utc)
+        # 2. Добавляем ровно 3 часа (МСК)
+        dt_msk = dt_utc + timedelta(hours=3)
+        return dt_msk.strftime('%d.%m.%Y %H:%M') + " (МСК)"
     return "Нет данных"
 
-def analyze_stats(events):
-    """
-    Анализирует список событий игрока.
-    Возвращает словарь со всеми счетчиками (золото, доблесть, этапы).
-    """
-    stats = {
-        "s1": 0, "s2": 0, "s3": 0, "s4": 0, "s5": 0, "s6": 0, "s7": 0,
-        "adepts": 0, "dances": 0,
-        "total_gold": 0,
-        "total_valor": 0
-    }
-    
-    events.sort(key=lambda x: x[0])
-    
-    for i, (ts, val, etype) in enumerate(events):
-        # Золото
-        if etype == 2:
-            stats['total_gold'] += val
-            continue 
-            
-        # Доблесть
-        if etype == 1:
-            stats['total_valor'] += val
-            
-            # Этапы КХ
-            if val == 4:
-                is_dance = False
-                # Проверка назад (< 20 мин)
-                if i > 0:
-                    prev_ts, prev_val, prev_type = events[i-1]
-                    if prev_type == 1 and prev_val == 2 and (ts - prev_ts) < 1200:
-                        is_dance = True
-                
-                # Проверка вперед (< 20 мин)
-                if not is_dance and i < len(events) - 1:
-                    next_ts, next_val, next_type = events[i+1]
-                    if next_type == 1 and next_val == 8 and (next_ts - ts) < 1200:
-                        is_dance = True
-                
-                if is_dance: stats['dances'] += 1
-                else: stats['s1'] += 1
-            
-            elif val == 6: stats['s2'] += 1
-            elif val == 10: stats['s3'] += 1
-            elif val == 14: stats['s4'] += 1
-            elif val == 24: stats['s5'] += 1
-            elif val == 40: stats['s6'] += 1
-            elif val == 70: stats['s7'] += 1
-            elif val == 7: stats['adepts'] += 1
-            elif val in [2, 8]: stats['dances'] += 1
-            
-    return stats
+async def data_generation():
+    """(поколение данных, время последнего изменения) - ключ годности кэша."""
+    async with db.read() as conn:
+        return await get_generation(conn)
 
-async def get_data_from_db(start_date: str = None, end_date: str = None, classes: List[int] = None):
+def cache_headers(etag, updated_at):
+    # no-cache: браузер хранит ответ, но каждый раз сверяет ETag (и получает 304)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if updated_at:
+        headers["Last-Modified"] = formatdate(updated_at, usegmt=True)
+    return headers
+
+def not_modified(request: Request, etag, updated_at):
+    """Есть ли у клиента актуальная копия (If-None-Match, иначе If-Modified-Since)."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or f"W/{etag}" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and updated_at:
+        try:
+            return parsedate_to_datetime(if_modified_since).timestamp() >= updated_at
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def json_bytes(content):
+    """Тело JSON-ответа (orjson, если установлен)."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def json_response(body, headers=None):
+    return Response(body, media_type="application/json", headers=headers)
+
+def default_range(start_date: str = None, end_date: str = None):
+    """Период по умолчанию: с понедельника текущей недели по сегодня."""
     today = datetime.now()
     if not end_date: end_date = today.strftime('%Y-%m-%d')
     
@@ -99,109 +148,173 @@ async def get_data_from_db(start_date: str = None, end_date: str = None, classes
         days_to_subtract = today.weekday()
         monday = today - timedelta(days=days_to_subtract)
         start_date = monday.strftime('%Y-%m-%d')
+    return start_date, end_date
 
-    async with aiosqlite.connect(DB_NAME) as conn:
-        # Базовый SQL
-        sql = """
-            SELECT 
-                p.role_id, 
-                COALESCE(p.nickname, 'ID ' || p.role_id), 
-                p.class_id,
-                e.timestamp, 
-                e.value, 
-                e.event_type
-            FROM players p
-            LEFT JOIN events e ON p.role_id = e.role_id 
-                AND e.event_type IN (1, 2)
-                AND substr(e.event_date, 1, 10) >= ? 
-                AND substr(e.event_date, 1, 10) <= ?
-            WHERE p.in_clan = 1
-        """
-        params = [start_date, end_date]
-        
-        # Фильтр по классам
-        if classes:
-            placeholders = ",".join("?" * len(classes))
-            sql += f" AND p.class_id IN ({placeholders})"
-            params.extend(classes)
+async def totals_from_events(conn, start_date, end_date, role_ids):
+    """
+    Итоги за период прямо по events (векторный analyze_stats_batch), в формате
+    LeaderboardIndex.totals. Нужны, пока daily_stats не заполнена фоновой миграцией.
+    """
+    async with conn.execute("""
+        SELECT role_id, timestamp, value, event_type FROM events
+        WHERE event_type IN (1, 2) AND event_date BETWEEN ? AND ?
+        ORDER BY role_id, timestamp, id
+    """, (start_date, end_date + " 23:59:59")) as cursor:
+        rows = await cursor.fetchall()
+    stats = analyze_stats_batch(*zip(*rows)) if rows else {}
 
-        cursor = await conn.execute(sql, tuple(params))
-        raw_rows = await cursor.fetchall()
+    totals = {}
+    for rid in role_ids:
+        player = stats.get(rid)
+        sums = {key: player[key] if player else 0 for key in STAGE_KEYS}
+        sums["gold"] = player["total_gold"] if player else 0
+        sums["valor"] = player["total_valor"] if player else 0
+        totals[rid] = sums
+    return totals
 
-    # Группировка
-    players_events = {}
-    for rid, name, cid, ts, val, etype in raw_rows:
-        if rid not in players_events:
-            players_events[rid] = {"name": name, "class_id": cid, "events": []}
-        players_events[rid]["events"].append((ts, val, etype))
+async def load_player_stats(conn, start_date, end_date, classes=None, role_ids=None):
+    """
+    Итоги игроков клана за период (словари для таблиц КХ и вкладов).
+    role_ids - только эти игроки (для живых обновлений).
+    """
+    global rollups_ready
+    await directory.sync(conn)
+    # Игроки клана (с фильтром по классам) - из справочника, без запроса к players
+    members = directory.members(classes, role_ids)
+
+    if not rollups_ready:
+        rollups_ready = await backfill_done(conn, "daily_stats")
+    if rollups_ready:
+        # Суммы за период - из индекса префиксных сумм по daily_stats
+        await leaderboard.sync(conn)
+        totals = leaderboard.totals(day_number(start_date), day_number(end_date), members)
+    else:
+        # Сводка еще заполняется фоном - считаем по событиям периода
+        totals = await totals_from_events(conn, start_date, end_date, members)
 
     result = []
-    for rid, data in players_events.items():
-        stats = analyze_stats(data["events"])
-        stats["name"] = data["name"]
-        
-        # Mapping Class
-        cid = data["class_id"]
-        if cid in CLASSES:
-            cname, cemoji, cshort = CLASSES[cid]
-            stats["class_icon"] = f"/static/icons/{cid}.png"
-            stats["class_name"] = cname
-        else:
-            stats["class_icon"] = ""
-            stats["class_name"] = ""
-            
+    for rid in members:
+        sums = totals[rid]
+        stats = {key: sums[key] for key in STAGE_KEYS}
+        stats["total_gold"] = sums["gold"]
+        stats["total_valor"] = sums["valor"]
+        stats["role_id"] = rid
+        info = directory.info(rid)
+        stats["name"] = info["name"]
+        stats["class_icon"] = info["class_icon"]
+        stats["class_name"] = info["class_name"]
         result.append(stats)
+    return result
+
+async def get_data_from_db(start_date: str = None, end_date: str = None, classes: List[int] = None):
+    start_date, end_date = default_range(start_date, end_date)
+
+    async with db.read() as conn:
+        result = await load_player_stats(conn, start_date, end_date, classes)
 
     # Сортировка: Сначала по 7 этапу, потом по общей доблести
     result.sort(key=lambda x: (x['s7'], x['total_valor']), reverse=True)
     
     return result, start_date, end_date
 
-# --- ROUTES (МАРШРУТЫ) ---
+# --- ЖИВЫЕ ОБНОВЛЕНИЯ (SSE) ---
 
-@app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request, start: str = None, end: str = None, classes: List[int] = Query(None)):
-    if start == "": start = None
-    if end == "": end = None
-    
-    rows, s_date, e_date = await get_data_from_db(start, end, classes)
-    
-    # --- История (все события с учетом фильтра по датам) ---
-    async with aiosqlite.connect(DB_NAME) as conn:
-        # Показываем ВСЕ типы событий: вклады золота/доблести, предметы, гильдийные действия
-        sql_history = """
-            SELECT 
-                e.event_date,
-                COALESCE(p.nickname, 'ID ' || e.role_id) as name,
-                p.class_id,
-                e.raw_desc,
-                e.event_type,
-                e.role_id
-            FROM events e
-            LEFT JOIN players p ON e.role_id = p.role_id
-            WHERE substr(e.event_date, 1, 10) >= ? 
-              AND substr(e.event_date, 1, 10) <= ?
-        """
-        params = [s_date, e_date]
-        if classes:
-            placeholders = ",".join("?" * len(classes))
-            sql_history += f" AND p.class_id IN ({placeholders})"
-            params.extend(classes)
-            
-        sql_history += " ORDER BY e.timestamp DESC"
-        
-        cursor = await conn.execute(sql_history, tuple(params))
-        raw_history = await cursor.fetchall()
-
-    history_rows = []
-    for date, name, cid, desc, etype, role_id in raw_history:
-        # emoji = CLASSES.get(cid, ("", "", ""))[1] if cid is not None else ""
-        icon_url = f"/static/icons/{cid}.png" if cid is not None and cid in CLASSES else ""
-        cname = CLASSES[cid][0] if cid is not None and cid in CLASSES else ""
-        history_rows.append((date, name, icon_url, cname, desc, etype, role_id))
-    
-    last_upd = await get_last_update_time()
-    
+LIVE_POLL_INTERVAL = 3    # Как часто проверять поколение данных (записи из бота)
+LIVE_KEEPALIVE = 20       # Пинг открытого соединения, сек
+LIVE_MAX_EVENTS = 500     # Больше новых событий за раз - страница просто перезагрузится
+
+async def after_ingest(conn, roles):
+    """Хук очереди загрузок: обновить индекс и справочник, сразу разослать изменения."""
+    await leaderboard.update_roles(conn, roles)
+    # Новые игроки и смена статуса в клане; таблица players небольшая - перечитываем целиком
+    await directory.load(conn)
+    live.notify()
+    snapshots.notify()
+
+async def live_loop():
+    """
+    Рассылает открытым страницам новые события и итоги затронутых игроков.
+    Просыпается после загрузки в этом процессе или раз в LIVE_POLL_INTERVAL
+    (загрузки через бота видны по счетчику поколений).
+    """
+    last_generation = None
+    last_id = None
+    while True:
+        try:
+            await live.wait(LIVE_POLL_INTERVAL)
+            async with db.read() as conn:
+                generation, _ = await get_generation(conn)
+                if last_id is None or not live.subscribers:
+                    # Никто не смотрит - просто запоминаем, откуда продолжать
+                    async with conn.execute("SELECT COALESCE(MAX(id), 0) FROM events") as cursor:
+                        last_id = (await cursor.fetchone())[0]
+                    last_generation = generation
+                    continue
+                if generation == last_generation:
+                    continue
+
+                async with conn.execute(f"""
+                    SELECT {HISTORY_COLUMNS}
+                    FROM events e
+                    WHERE e.id > ?
+                    ORDER BY e.day DESC, e.timestamp DESC, e.id DESC
+                    LIMIT ?
+                """, (last_id, LIVE_MAX_EVENTS + 1)) as cursor:
+                    new_events = await cursor.fetchall()
+                last_generation = generation
+                if not new_events:
+                    continue
+                last_id = max(last_id, max(r[0] for r in new_events))
+                await directory.sync(conn)
+
+                if len(new_events) > LIVE_MAX_EVENTS:
+                    async def build(filters):
+                        return {"reload": True}
+                else:
+                    roles = sorted({r[4] for r in new_events})
+
+                    async def build(filters):
+                        history = [
+                            history_row(*r) for r in new_events
+                            if r[1] is not None and filters["start_day"] <= r[1] <= filters["end_day"]
+                            and (not filters["classes"] or directory.info(r[4])["class_id"] in filters["classes"])
+                        ]
+                        players = await load_player_stats(
+                            conn, filters["start"], filters["end"], filters["classes"], roles
+                        )
+                        if not history and not players:
+                            return None
+                        shown = {p["role_id"] for p in players}
+                        return {
+                            "generation": generation,
+                            "history": history,
+                            "players": players,
+                            "removed": [rid for rid in roles if rid not in shown],
+                        }
+
+                await live.publish(build)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка живых обновлений: {e}")
+
+# --- СНИМКИ ЧАСТЫХ ПЕРИОДОВ ---
+
+SNAPSHOT_POLL_INTERVAL = 10  # Проверка поколения (правки, загрузки через бота) и смены дня
+
+def stats_payload(rows, start_date, end_date, generation, updated_at):
+    """Ответ /api/stats (он же содержимое снимка)."""
+    return {
+        "status": "ok",
+        "start": start_date,
+        "end": end_date,
+        "generation": generation,
+        "last_updated": get_last_update_time(updated_at),
+        "rows": rows,
+    }
+
+def render_page(start_date, end_date, classes, updated_at, snapshot_url=None):
+    """HTML оболочки страницы; snapshot_url - готовые итоги вместо /api/stats."""
     # Подготовка списка классов для фильтра
     # CLASSES format: {id: (name, emoji, short)}
     all_classes_list = []
@@ -215,18 +328,275 @@ async def read_root(request: Request, start: str = None, end: str = None, classe
     # Сортировка по ID
     all_classes_list.sort(key=lambda x: x['id'])
 
-    return templates.TemplateResponse("index.html", {
-        "request": request, 
-        "rows": rows, 
-        "current_start": s_date, 
-        "current_end": e_date,
-        "last_updated": last_upd,
-        "history_rows": history_rows,
+    return templates.get_template("index.html").render({
+        "current_start": start_date, 
+        "current_end": end_date,
+        "last_updated": get_last_update_time(updated_at),
         "all_classes": all_classes_list,
         "selected_classes": classes or [],
+        "snapshot_url": snapshot_url,
         "CLASSES": CLASSES  # Для модального окна редактирования
     })
 
+async def snapshot_loop():
+    """Пересобирает снимки после загрузки (notify), правок и смены дня."""
+    while True:
+        try:
+            await snapshots.wait(SNAPSHOT_POLL_INTERVAL)
+            generation, updated_at = await data_generation()
+            if snapshots.is_current(generation):
+                continue
+
+            async def build(start_date, end_date):
+                rows, start_date, end_date = await get_data_from_db(start_date, end_date)
+                return json_bytes(stats_payload(rows, start_date, end_date, generation, updated_at))
+
+            def page(url):
+                start_date, end_date = default_range()
+                return render_page(start_date, end_date, None, updated_at, url)
+
+            await snapshots.rebuild(generation, build, page)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка обновления снимков: {e}")
+
+# --- ROUTES (МАРШРУТЫ) ---
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request, start: str = None, end: str = None, classes: List[int] = Query(None)):
+    if start == "": start = None
+    if end == "": end = None
+    
+    # Страница меняется только при новых данных: отдаем 304 или готовый HTML из кэша
+    generation, updated_at = await data_generation()
+    s_date, e_date = default_range(start, end)
+    # Частый период без фильтра классов - итоги из статического снимка
+    snapshot_url = snapshots.url_for(generation, s_date, e_date, classes)
+    key = ("page", s_date, e_date, tuple(sorted(classes or [])), snapshot_url)
+    etag = make_etag(generation, key)
+    headers = cache_headers(etag, updated_at)
+    if not_modified(request, etag, updated_at):
+        return Response(status_code=304, headers=headers)
+    body = page_cache.get(key, generation)
+    if body is None:
+        # Страница - оболочка: таблицы грузят данные через /api/stats и /api/history
+        body = page_cache.put(key, generation, render_page(s_date, e_date, classes, updated_at, snapshot_url))
+    return HTMLResponse(body, headers=headers)
+
+@app.get("/api/stats")
+async def get_stats(request: Request, start: str = None, end: str = None, classes: List[int] = Query(None)):
+    """Итоги игроков клана за период (строки таблиц КХ и вкладов), как get_data_from_db."""
+    try:
+        s_date, e_date = default_range(start or None, end or None)
+        generation, updated_at = await data_generation()
+        key = ("stats", s_date, e_date, tuple(sorted(classes or [])))
+        etag = make_etag(generation, key)
+        headers = cache_headers(etag, updated_at)
+        if not_modified(request, etag, updated_at):
+            return Response(status_code=304, headers=headers)
+        cached = page_cache.get(key, generation)
+        if cached is not None:
+            return json_response(cached, headers)
+
+        rows, s_date, e_date = await get_data_from_db(s_date, e_date, classes)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+    result = stats_payload(rows, s_date, e_date, generation, updated_at)
+    return json_response(page_cache.put(key, generation, json_bytes(result)), headers)
+
+@app.get("/api/players")
+async def get_players(request: Request):
+    """Справочник игроков: role_id, ник, класс, состоит ли в клане."""
+    try:
+        generation, updated_at = await data_generation()
+        key = ("players",)
+        etag = make_etag(generation, key)
+        headers = cache_headers(etag, updated_at)
+        if not_modified(request, etag, updated_at):
+            return Response(status_code=304, headers=headers)
+        cached = page_cache.get(key, generation)
+        if cached is not None:
+            return json_response(cached, headers)
+
+        async with db.read() as conn:
+            await directory.sync(conn)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+    players = [
+        {"role_id": rid, **directory.info(rid), "in_clan": in_clan}
+        for rid, (_, _, in_clan) in sorted(directory.players.items())
+    ]
+    result = {"status": "ok", "generation": generation, "players": players}
+    return json_response(page_cache.put(key, generation, json_bytes(result)), headers)
+
+HISTORY_PAGE_MAX = 200
+
+# Колонки строки истории (порядок важен для history_row)
+HISTORY_COLUMNS = """
+    e.id,
+    e.day,
+    e.timestamp,
+    e.event_date,
+    e.role_id,
+    e.raw_desc,
+    e.event_type,
+    e.value
+"""
+
+def history_row(eid, day, ts, date, role_id, desc, etype, value):
+    """
+    Строка таблицы истории; cursor - ключ для продолжения списка после нее.
+    Ник и класс - из справочника, "ID цели" в описании заменяется ее ником.
+    """
+    info = directory.info(role_id)
+    return {
+        "id": eid,
+        "cursor": f"{day if day is not None else day_number(date)}:{ts}:{eid}",
+        "date": date,
+        "role_id": role_id,
+        "name": info["name"],
+        "class_icon": info["class_icon"],
+        "class_name": info["class_name"],
+        "desc": directory.describe(desc, etype, value),
+        "type": etype,
+    }
+
+def in_clause(column, ids):
+    """Условие "column IN (...)" и параметры; пустой список - условие, ложное для всех строк."""
+    if not ids:
+        return "0", []
+    return f"{column} IN ({','.join('?' * len(ids))})", list(ids)
+
+@app.get("/api/history")
+async def get_history(request: Request, start: str = None, end: str = None, classes: List[int] = Query(None),
+                      types: List[int] = Query(None), search: str = "", cursor: str = None,
+                      limit: int = 50):
+    """
+    История событий постранично (новые сверху) для таблицы на странице.
+    Пагинация по ключу (timestamp, id): cursor - значение next_cursor из прошлого ответа.
+    search - подстрока ника (игрока или цели события), описания или даты без учета регистра
+    либо точный ID игрока.
+    """
+    global event_days_ready
+    try:
+        s_date, e_date = default_range(start or None, end or None)
+        limit = max(1, min(limit, HISTORY_PAGE_MAX))
+        search = search.strip()
+
+        generation, updated_at = await data_generation()
+        key = ("history", s_date, e_date, tuple(sorted(classes or [])), tuple(sorted(types or [])),
+               search, cursor, limit)
+        etag = make_etag(generation, key)
+        headers = cache_headers(etag, updated_at)
+        if not_modified(request, etag, updated_at):
+            return Response(status_code=304, headers=headers)
+        cached = page_cache.get(key, generation)
+        if cached is not None:
+            return json_response(cached, headers)
+
+        async with db.read() as conn:
+            await directory.sync(conn)
+            if not event_days_ready:
+                event_days_ready = await backfill_done(conn, "event_day")
+
+        # Ники и классы - из справочника: фильтры превращаются в списки role_id.
+        # "+e.role_id" не дает планировщику уйти с индекса (day, timestamp) на индекс игрока
+        if event_days_ready:
+            sql = f"""
+                SELECT {HISTORY_COLUMNS}
+                FROM events e
+                WHERE e.day BETWEEN ? AND ?
+            """
+            params = [day_number(s_date), day_number(e_date)]
+        else:
+            # У старых строк day еще не заполнен - период по event_date (индекс idx_date)
+            sql = f"""
+                SELECT {HISTORY_COLUMNS}
+                FROM events e
+                WHERE e.event_date BETWEEN ? AND ?
+            """
+            params = [s_date, e_date + " 23:59:59"]
+        if classes:
+            clause, ids = in_clause("+e.role_id", directory.with_classes(classes))
+            sql += f" AND {clause}"
+            params.extend(ids)
+        if types:
+            sql += f" AND e.event_type IN ({','.join('?' * len(types))})"
+            params.extend(types)
+        if search:
+            # Описания - кириллица: регистр сравниваем через casefold, а не встроенный LIKE (только ASCII)
+            pattern = search_pattern(search)
+            sql += " AND (casefold(e.raw_desc) LIKE ? ESCAPE '\\' OR e.event_date LIKE ? ESCAPE '\\'"
+            params.extend([pattern, pattern])
+            named = directory.search(search)
+            if named:
+                by_player, ids = in_clause("+e.role_id", named)
+                by_target, _ = in_clause("e.value", named)
+                sql += f" OR {by_player} OR (e.event_type IN ({','.join(map(str, TARGET_TYPES))}) AND {by_target})"
+                params.extend(ids + ids)
+            if search.isdigit():
+                sql += " OR e.role_id = ?"
+                params.append(int(search))
+            sql += ")"
+        if cursor:
+            # День в ключе - чтобы идти по индексу (day, timestamp); день растет вместе с timestamp,
+            # поэтому без day порядок и продолжение по (timestamp, id) те же
+            c_day, c_ts, c_id = (int(x) for x in cursor.split(":"))
+            if event_days_ready:
+                sql += " AND (e.day, e.timestamp, e.id) < (?, ?, ?)"
+                params.extend([c_day, c_ts, c_id])
+            else:
+                sql += " AND (e.timestamp, e.id) < (?, ?)"
+                params.extend([c_ts, c_id])
+        if event_days_ready:
+            sql += " ORDER BY e.day DESC, e.timestamp DESC, e.id DESC LIMIT ?"
+        else:
+            sql += " ORDER BY e.timestamp DESC, e.id DESC LIMIT ?"
+        params.append(limit + 1)
+
+        async with db.read() as conn:
+            cur = await conn.execute(sql, tuple(params))
+            raw = await cur.fetchall()
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+    has_more = len(raw) > limit
+    rows = [history_row(*r) for r in raw[:limit]]
+    next_cursor = rows[-1]["cursor"] if has_more else None
+    result = {"status": "ok", "rows": rows, "next_cursor": next_cursor, "has_more": has_more}
+    return json_response(page_cache.put(key, generation, json_bytes(result)), headers)
+
+@app.get("/api/export")
+async def export_report(format: str = "csv", start: str = None, end: str = None,
+                        classes: List[int] = Query(None)):
+    """
+    Выгрузка сводки по дням (колонки /report + этапы) в CSV или XLSX.
+    Без start/end - весь архив. Строки идут из курсора порциями, файл целиком в памяти не собирается.
+    """
+    if format not in EXPORT_FORMATS:
+        return JSONResponse({"status": "error", "message": f"Unknown format: {format}"}, status_code=400)
+    try:
+        start_day = day_number(start) if start else None
+        end_day = day_number(end) if end else None
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+
+    async def stream():
+        # Свое соединение на всю скачку - пул читателей не ждет медленного клиента
+        async with db.stream() as conn:
+            async for chunk in export_stream(format, export_rows(conn, start_day, end_day, classes)):
+                yield chunk
+
+    filename = f"report_{datetime.now().strftime('%Y%m%d')}.{format}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if format == "xlsx":
+        # XLSX - уже zip: GZipMiddleware пропускает ответы с заданным Content-Encoding
+        headers["Content-Encoding"] = "identity"
+    return StreamingResponse(stream(), media_type=EXPORT_FORMATS[format], headers=headers)
+
 @app.get("/download/watcher")
 async def download_watcher():
     exe_path = "dist/PW_Requiem_history.exe"
@@ -255,65 +625,123 @@ async def download_watcher():
 
     return FileResponse(path=zip_path, filename="PW_Requiem_history.zip", media_type='application/zip')
 
+async def enqueue_upload(conn, data, filename):
+    """Проверяет журнал загрузок и ставит файл в очередь. Возвращает ответ по одному файлу."""
+    digest = file_digest(data)
+    if await ledger_has(conn, digest):
+        return {"status": "ok", "duplicate": True, "new_events": 0, "total_parsed": 0}
+
+    job_id = ingest_queue.submit(data, filename, digest)
+    if job_id is None:
+        return {"status": "error", "message": "Server busy, retry later"}
+    return {"status": "ok", "job_id": job_id, "state": "queued"}
+
 @app.post("/api/upload")
 async def upload_log(file: UploadFile = File(...)):
-    """API endpoint для загрузки логов через утилиту"""
-    temp_path = f"temp_upload_{file.filename}"
-    
+    """
+    API endpoint для загрузки логов через утилиту.
+    Файл ставится в очередь и разбирается в фоне; статус - /api/upload/{job_id}.
+    """
     try:
-        # 1. Сохраняем файл
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-            
-        # 2. Парсим
-        data = parse_board_file(temp_path)
-        if not data:
-            return {"status": "error", "message": "File empty or data too old"}
-            
-        new_events = 0
-        
-        # 3. Пишем в БД (Логика идентична боту)
-        async with aiosqlite.connect(DB_NAME) as conn:
-            cursor = await conn.cursor()
-            
-            for row in data:
-                rid = row['role_id']
-                etype = row['action_type']
-                desc = row['description'].lower()
-                val = 0
-                if row['raw_params']:
-                    try:
-                        val = int(row['raw_params'].split(',')[0])
-                    except: pass
-
-                # Игрок
-                await cursor.execute("INSERT OR IGNORE INTO players (role_id, in_clan) VALUES (?, 1)", (rid,))
-                
-                # Статус
-                is_leave = "покинул" in desc or "изгнан" in desc or "вышел" in desc
-                if is_leave:
-                    await cursor.execute("UPDATE players SET in_clan = 0 WHERE role_id = ?", (rid,))
-                elif etype in [1, 2] or "принят" in desc or "joined" in desc:
-                    await cursor.execute("UPDATE players SET in_clan = 1 WHERE role_id = ?", (rid,))
-                
-                # Событие
-                await cursor.execute("""
-                    INSERT INTO events (role_id, timestamp, event_date, event_type, value, raw_desc)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (rid, row['timestamp'], row['date'], etype, val, row['description']))
-                
-                if cursor.rowcount > 0:
-                    new_events += 1
-                    
-            await conn.commit()
-            
-        return {"status": "ok", "new_events": new_events, "total_parsed": len(data)}
+        data = await file.read()
+        async with db.read() as conn:
+            return await enqueue_upload(conn, data, file.filename)
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
 
+@app.post("/api/upload/batch")
+async def upload_batch(files: List[UploadFile] = File(...), encoding: str = Form("identity")):
+    """
+    Пакетная загрузка: много файлов одним запросом.
+    encoding=gzip - каждый файл сжат gzip. Ответ - результат по каждому файлу,
+    утилита удаляет только успешно обработанные.
+    """
+    if encoding not in ("identity", "gzip"):
+        return {"status": "error", "message": f"Unsupported encoding: {encoding}"}
+
+    results = []
+    async with db.read() as conn:
+        for file in files:
+            try:
+                data = await file.read()
+                if encoding == "gzip":
+                    data = gzip.decompress(data)
+                res = await enqueue_upload(conn, data, file.filename)
+            except Exception as e:
+                res = {"status": "error", "message": str(e)}
+            results.append({"filename": file.filename, **res})
+    return {"status": "ok", "results": results}
+
+@app.post("/api/upload/delta")
+async def upload_delta(file: UploadFile = File(...), offset: int = Form(0), encoding: str = Form("identity")):
+    """
+    Хвост живого файла от утилиты в режиме tail: заголовок (8 байт) + только
+    дописанные записи. offset - с какого байта исходного файла начинается хвост.
+    """
+    try:
+        data = await file.read()
+        if encoding == "gzip":
+            data = gzip.decompress(data)
+        if offset < HEADER_SIZE or (offset - HEADER_SIZE) % RECORD_SIZE or \
+                len(data) < HEADER_SIZE or (len(data) - HEADER_SIZE) % RECORD_SIZE:
+            return {"status": "error", "message": "Delta must be a header plus whole 28-byte records"}
+        async with db.read() as conn:
+            return await enqueue_upload(conn, data, file.filename)
     except Exception as e:
         return {"status": "error", "message": str(e)}
-    finally:
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+
+@app.get("/api/upload/check")
+async def upload_check(sha256: List[str] = Query(...)):
+    """
+    Быстрая проверка по хэшу: загружался ли уже такой файл (тело не нужно).
+    Можно передать несколько sha256 - вернется список известных.
+    """
+    async with db.read() as conn:
+        known = [h for h in (h.lower() for h in sha256) if await ledger_has(conn, h)]
+    return {"status": "ok", "known": bool(known), "known_hashes": known}
+
+@app.get("/api/upload/{job_id}")
+async def upload_status(job_id: str):
+    """Статус фоновой загрузки: queued / parsing / writing / done / error"""
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return {"status": "error", "message": f"Job {job_id} not found"}
+    return {"status": "ok", "job_id": job_id, **job}
+
+@app.get("/api/live")
+async def live_stream(request: Request, start: str = None, end: str = None, classes: List[int] = Query(None)):
+    """
+    Поток Server-Sent Events для открытой страницы: события "delta" с новыми
+    строками истории и свежими итогами игроков под ее период и классы.
+    """
+    s_date, e_date = default_range(start or None, end or None)
+    try:
+        start_day, end_day = day_number(s_date), day_number(e_date)
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=400)
+    queue = live.subscribe({
+        "start": s_date, "end": e_date,
+        "start_day": start_day, "end_day": end_day,
+        "classes": classes or [],
+    })
+
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), LIVE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected() or not live.is_subscribed(queue):
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield sse("delta", message)
+        finally:
+            live.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/api/update_nickname")
 async def update_nickname(request: Request):
@@ -326,7 +754,7 @@ async def update_nickname(request: Request):
         if not role_id:
             return {"status": "error", "message": "role_id is required"}
         
-        async with aiosqlite.connect(DB_NAME) as conn:
+        async with db.write() as conn:
             # Проверяем существование игрока
             async with conn.execute("SELECT 1 FROM players WHERE role_id = ?", (role_id,)) as cursor:
                 if not await cursor.fetchone():
@@ -337,7 +765,9 @@ async def update_nickname(request: Request):
                 await conn.execute("UPDATE players SET nickname = ? WHERE role_id = ?", (nickname, role_id))
             else:
                 await conn.execute("UPDATE players SET nickname = NULL WHERE role_id = ?", (role_id,))
+            await bump_generation(conn)
             await conn.commit()
+        directory.set_nickname(int(role_id), nickname)
             
         return {"status": "ok", "message": f"Nickname updated for ID {role_id}"}
     except Exception as e:
@@ -358,7 +788,7 @@ async def update_class(request: Request):
         if class_id is not None and class_id not in CLASSES and class_id != -1:
             return {"status": "error", "message": f"Invalid class_id: {class_id}"}
         
-        async with aiosqlite.connect(DB_NAME) as conn:
+        async with db.write() as conn:
             # Проверяем существование игрока
             async with conn.execute("SELECT 1 FROM players WHERE role_id = ?", (role_id,)) as cursor:
                 if not await cursor.fetchone():
@@ -366,7 +796,9 @@ async def update_class(request: Request):
             
             # Обновляем класс
             await conn.execute("UPDATE players SET class_id = ? WHERE role_id = ?", (class_id, role_id))
+            await bump_generation(conn)
             await conn.commit()
+        directory.set_class(int(role_id), class_id)
             
         class_name = CLASSES.get(class_id, ("Неизвестно", "", ""))[0] if class_id in CLASSES else "Не указан"
         return {"status": "ok", "message": f"Class updated for ID {role_id} to {class_name}"}